@@ -0,0 +1,59 @@
+# Purpose of the script: compare the csv reader engines of clean_and_validate.py on the raw data file.
+
+# Input: the raw data file (see RAW_PATH in clean_and_validate.py), tiled up to the requested number of rows and
+# written to a temporary csv file.
+
+# Output: best wall time and rows per second for each reader engine, printed as a table.
+
+# Usage (from the repository root): python scripts/benchmark_readers.py --rows 1000000 --repeat 3
+
+# Imports
+from pathlib import Path
+from typing import Optional
+import argparse
+import importlib.util
+import tempfile
+import time
+
+import pandas as pd
+
+import clean_and_validate as cv
+
+# Functions
+
+# Write the raw data tiled up to n_rows rows into csv_path
+def write_tiled_csv(csv_path: Path, n_rows: int) -> None:
+    df = pd.read_csv(cv.RAW_PATH)
+    repeats = -(-n_rows // len(df))
+    pd.concat([df] * repeats, ignore_index=True).iloc[:n_rows].to_csv(csv_path, index=False)
+
+# Best wall time over all repeats for reading csv_path with one engine
+def time_engine(csv_path: Path, engine: str, typed: bool, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        next(cv.read_raw(csv_path, typed=typed, engine=engine))
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the raw csv reader engines.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Number of rows in the benchmark file.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions per engine; the best one is reported.")
+    parser.add_argument("--infer-dtypes", action="store_true", help="Read without the explicit dtype map.")
+    args = parser.parse_args(argv)
+
+    engines = [e for e in cv.READER_ENGINES if e != "pyarrow" or importlib.util.find_spec("pyarrow") is not None]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = Path(tmp) / "raw.csv"
+        write_tiled_csv(csv_path, args.rows)
+
+        print(f"{'engine':<10}{'rows':>12}{'best s':>10}{'rows/s':>14}")
+        for engine in engines:
+            seconds = time_engine(csv_path, engine, not args.infer_dtypes, args.repeat)
+            print(f"{engine:<10}{args.rows:>12}{seconds:>10.3f}{args.rows / seconds:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
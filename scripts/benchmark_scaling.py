@@ -0,0 +1,128 @@
+# Purpose of the script: measure how the full validate-and-write path of clean_and_validate.py scales with data size.
+
+# For every requested size a synthetic raw file is generated with generate_synthetic_data.py (fixed seed, so the same
+# size always means the same data) and the pipeline runs on it in a fresh worker process. The report lists wall time,
+# CPU time, throughput and peak RSS per size, plus the scaling exponents between successive sizes (1.0 means linear).
+# With --output the results are also saved as JSON together with the git commit, library versions and machine, so
+# runs of different commits can be compared.
+
+# Usage (from the repository root):
+# python scripts/benchmark_scaling.py --sizes 1e5 1e6 1e7 --work-dir data/synthetic --output bench.json
+
+# Imports
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import generate_synthetic_data as gen
+
+# Functions
+
+# Worker: run the pipeline once in this (fresh) process and return its measurements
+def run_pipeline(raw_path: str, out_path: str, options: dict) -> dict:
+    import resource
+
+    import clean_and_validate as cv
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    options = dict(options)
+    chunk_size = options.pop("chunk_size", None)
+    if chunk_size is not None:
+        rows = cv.run_streaming(Path(raw_path), Path(out_path), chunk_size, **options)
+    else:
+        rows = cv.run_full(Path(raw_path), Path(out_path), **options)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "rows": rows,
+        "wall_seconds": time.perf_counter() - wall_start,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "peak_rss_bytes": peak_rss if sys.platform == "darwin" else peak_rss * 1024,
+    }
+
+# Commit, library versions and machine of this benchmark run
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "cpu_count": os.cpu_count(),
+    }
+
+# Scaling exponent between two measurements: log(time ratio) / log(size ratio)
+def scaling_exponent(smaller: dict, larger: dict) -> float:
+    return math.log(larger["wall_seconds"] / smaller["wall_seconds"]) / math.log(larger["rows"] / smaller["rows"])
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the validate-and-write path.")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1e5, 1e6, 1e7], help="Row counts, e.g. 1e5 1e6.")
+    parser.add_argument("--work-dir", type=Path, default=None,
+                        help="Folder for the generated files; they are reused across runs. Default: a temporary folder.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data.")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Run in streaming mode with this chunk size.")
+    parser.add_argument("--fused", action="store_true", help="Use the fused numeric validator.")
+    parser.add_argument("--engine", default="c", help="Reader engine.")
+    parser.add_argument("--output", type=Path, default=None, help="Save the results as JSON to this path.")
+    args = parser.parse_args(argv)
+
+    options = {"fused": args.fused, "engine": args.engine}
+    if args.chunk_size is not None:
+        options["chunk_size"] = args.chunk_size
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = args.work_dir or Path(tmp)
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        results = []
+        for size in sorted(int(s) for s in args.sizes):
+            raw_path = work_dir / f"synthetic_{size}_seed{args.seed}.csv"
+            if not raw_path.exists():
+                gen.generate(raw_path, size, seed=args.seed)
+
+            out_path = Path(tmp) / "cleaned.csv"
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(run_pipeline, str(raw_path), str(out_path), options).result()
+            results.append(result)
+
+    print(f"{'rows':>12}{'wall s':>10}{'cpu s':>10}{'rows/s':>14}{'peak MiB':>10}{'B/row':>8}{'exponent':>10}")
+    for i, result in enumerate(results):
+        exponent = f"{scaling_exponent(results[i - 1], result):.2f}" if i else "-"
+        print(
+            f"{result['rows']:>12}{result['wall_seconds']:>10.2f}{result['cpu_seconds']:>10.2f}"
+            f"{result['rows'] / result['wall_seconds']:>14,.0f}{result['peak_rss_bytes'] / 2**20:>10.1f}"
+            f"{result['peak_rss_bytes'] / result['rows']:>8.0f}{exponent:>10}"
+        )
+
+    if args.output is not None:
+        report = {"environment": environment(), "options": options, "results": results}
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
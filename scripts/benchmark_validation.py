@@ -0,0 +1,98 @@
+# Purpose of the script: compare the sequential validate_* functions with the single-pass fused validator, and the
+# cross-column checks (Units Returned <= Units Sold, the revenue formulas) on pandas Series with the blocked expression
+# engine that validate_units_returned and validate_revenue use.
+
+# Input: the raw data file (see RAW_PATH in clean_and_validate.py), tiled up to the requested number of rows.
+
+# Output: wall time and tracemalloc peak memory per validation path, printed as a table.
+
+# Usage (from the repository root): python scripts/benchmark_validation.py --rows 1000000 --repeat 3
+
+# Imports
+from typing import Callable, Optional
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import clean_and_validate as cv
+
+# Functions
+
+# Tile the raw data frame until it has n_rows rows, so the benchmark can run at sizes larger than the sample
+def load_tiled(n_rows: int) -> pd.DataFrame:
+    df = pd.read_csv(cv.RAW_PATH)
+    repeats = -(-n_rows // len(df))
+    return pd.concat([df] * repeats, ignore_index=True).iloc[:n_rows]
+
+def run_sequential(df: pd.DataFrame) -> None:
+    cv.validate_sold_units(df)
+    cv.validate_units_returned(df)
+    cv.validate_price(df)
+    cv.validate_discount(df)
+    cv.validate_revenue(df, cv.TOLERANCE)
+
+def run_fused(df: pd.DataFrame) -> None:
+    cv.validate_numeric_fused(df, cv.TOLERANCE)
+
+# Cross-column checks as whole-column Series operations (one full-length temporary per operator), for comparison
+def run_returned_series(df: pd.DataFrame) -> None:
+    (df["Units Returned"] > df["Units Sold"]).any()
+
+def run_returned_blocked(df: pd.DataFrame) -> None:
+    tree = (">", ("column", "Units Returned"), ("column", "Units Sold"))
+    cv.count_blocked(tree, cv.expression_arrays(df, ["Units Returned", "Units Sold"]), len(df))
+
+def run_revenue_series(df: pd.DataFrame) -> None:
+    revenue_f1 = df["Units Sold"] * df["Price"]
+    revenue_f2 = df["Units Sold"] * df["Price"] * (1 - df["Discount"])
+    revenue_f3 = df["Units Sold"] * df["Price"] * df["Discount"]
+    match = np.isclose(df["Revenue"], revenue_f1, atol=cv.TOLERANCE)
+    match |= np.isclose(df["Revenue"], revenue_f2, atol=cv.TOLERANCE)
+    match |= np.isclose(df["Revenue"], revenue_f3, atol=cv.TOLERANCE)
+    match.all()
+
+def run_revenue_blocked(df: pd.DataFrame) -> None:
+    cv.validate_revenue(df, cv.TOLERANCE)
+
+# Time one validation path; returns the best wall time over all repeats and the tracemalloc peak of a separate run
+def measure(func: Callable[[pd.DataFrame], None], df: pd.DataFrame, repeat: int) -> tuple:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(df)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(df)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings), peak
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark sequential vs fused numeric validation and Series vs blocked cross-column checks.")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Number of rows to validate.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions per path; the best one is reported.")
+    args = parser.parse_args(argv)
+
+    df = load_tiled(args.rows)
+    paths = {
+        "sequential": run_sequential,
+        "fused": run_fused,
+        "returned_series": run_returned_series,
+        "returned_blocked": run_returned_blocked,
+        "revenue_series": run_revenue_series,
+        "revenue_blocked": run_revenue_blocked,
+    }
+
+    print(f"{'path':<18}{'rows':>12}{'best s':>10}{'rows/s':>14}{'peak MiB':>10}")
+    for name, func in paths.items():
+        seconds, peak = measure(func, df, args.repeat)
+        print(f"{name:<18}{len(df):>12}{seconds:>10.3f}{len(df) / seconds:>14,.0f}{peak / 2**20:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,11 @@
 # Allowed value lists (Product Name, Category, Location, Platform) are defined in the script as constants. The expected table schema and required columns are defined in the script as constants.
 
 # Steps:
-# 1. open the raw data file
+# 1. open the raw data file; columns are read with the explicit dtype map (string columns as categoricals) unless
+#    --infer-dtypes is given; --engine selects the csv parser (pandas C, multithreaded pyarrow or pure Python)
 # 2. validate table structure against the expected schema
-# 3. convert data type in Date column from object to datetime, validate success of conversion
+# 3. convert data type in Date column from object to datetime using the fixed %Y-%m-%d format, parsing each distinct date
+#    string once; invalid or missing dates fail the run with their count and a sample of rows
 # 4. validate data types in all columns after Date column conversion 
 # 5. validate Product Name column by checking that all values are in the allowed Product Name list
 # 6. validate Category column by checking that all values are in the allowed Category list
@@ -20,19 +22,120 @@
 # 8. validate Units Returned column by checking that values are integers and not negative, and validating that Units Returned do not exceed Units Sold
 # 9. validate Price column by checking that values are positive
 # 10. validate Discount column by checking that values are between 0 and 1
-# 11. validate Revenue column by creating three temporary columns for three possible revenue calculation formulas
-# 12. compare respective values in each of the three new columns with the original Revenue column
-# 13. create three temporary columns with True / False validation results for revenue consistency
+# 11. validate Revenue column by computing three possible revenue calculation formulas, block by block without
+#     full-length temporary columns
+# 12. compare respective values of each of the three formulas with the original Revenue column
+# 13. combine the True / False validation results for revenue consistency per row
 # 14. validate that for each row at least one Revenue formula matches the original Revenue value within a small tolerance; if not, exit with an error
 # 15. validate Location column by checking that all values are in the allowed Location list
 # 16. validate Platform column by checking that all values are in the allowed Platform list
 # 17. drop all temporary columns created for revenue calculation and validation
 # 18. validate missing values by checking that required columns (as defined in the script schema) have no missing values
-# 19. create csv file with cleaned data
+# 19. create csv file with cleaned data; with --output-format parquet / feather the same data is also written as a
+#     parquet file (dictionary-encoded string columns, Date statistics per row group) and / or an uncompressed Arrow
+#     IPC file for memory-mapped reads, next to the csv file; with --partition-by the output is instead split into
+#     year / week (and optionally Location / Platform) partitions listed in a manifest with row counts and hashes
+
+# Streaming mode (--chunk-size N): steps 1-18 run on each chunk of N rows and every passing chunk is appended to a
+# staging file; the staging file replaces the cleaned csv file only after all chunks pass, so memory use is bounded
+# by the chunk size and a failed run never leaves a partial output behind.
+
+# Fused mode (--fused): steps 7-14 are evaluated by one blocked pass over the numeric columns that produces a
+# violation count per rule, instead of one scan per validate_* function. Every predicate is evaluated into block-sized
+# buffers, so fused mode holds no full-length temporaries (about 2 MiB at any size against 24 MiB for the default path
+# at 5M rows) and is somewhat faster; collect-all and quarantine mode keep the bitmasks of the rules that fire.
+
+# Parsed cache (--parsed-cache): the typed columns of the raw file are stored once as .npy files in a sidecar directory
+# keyed by the raw file's size, mtime and digest, and memory-mapped by later runs instead of parsing the csv file.
+
+# Rule spec (--rules PATH): steps 5-16 are read from a declarative TOML rule file (scripts/rules.toml mirrors the
+# built-in rules) and compiled into a plan that batches the checks per column and runs cheap checks first, while still
+# raising the error of the first failing rule in file order. Compare and formula rules run on the blocked expression
+# engine, which computes a shared sub-expression once per block.
+
+# Compact schema (--compact): after validation the numeric columns are downcast to COMPACT_DTYPES and the string
+# columns become categoricals with int8 codes, verified lossless, for a smaller frame and smaller columnar outputs.
+
+# Revenue formula inference (--infer-revenue-formula): steps 11-14 check every row against the formula that matches
+# most rows of a sample, and the other formulas only for the rows it misses; the formula that held is reported per
+# Platform / Location segment.
+
+# Exact revenue (--exact-revenue): steps 11-14 compare Revenue with the three formulas in int64 cents, with Discount
+# in basis points, so each formula is one integer comparison against a tolerance of whole cents.
+
+# Skip-if-unchanged (--skip-unchanged): every successful run with the flag records a run manifest (raw file size, mtime
+# and digest taken before reading, rule set fingerprint, options and output digests); when nothing changed the next
+# run with the flag exits before importing pandas. Runs without the flag do not hash their inputs and outputs.
+
+# Collect-all mode (--collect-all, --report): every rule is evaluated in one pass and all violations are reported at
+# once (rule, column, violation count, sampled row indices) instead of failing on the first rule. Integer columns are
+# read as float64, so missing and fractional values are row-level violations rather than read errors; a file with
+# text in a numeric column is read again with the numeric columns as text and the text reported per row.
+
+# Quarantine mode (--quarantine, --max-reject-rate): rows failing the Units Returned, Price, Discount, Revenue or
+# allowed value checks are written with their failure reasons to a rejects file next to the cleaned csv file and all
+# other rows to the cleaned output; the run still fails if the reject rate exceeds the maximum. As in collect-all mode,
+# integer columns are read as float64, so blank or fractional Units Returned values are rejected rows, not read errors.
+
+# Parallel mode (--workers N): the raw file is split at newline-aligned byte offsets into shards that are parsed and
+# validated (steps 1-18) in N worker processes; the parent merges the per-shard outputs and violation summaries.
+
+# Multi-file input (--input PATH): PATH is a raw file, a directory (the RAW_FILE_PATTERNS files in it) or a glob
+# pattern. The files are split into shards and processed as in parallel mode, each shard checked against the schema
+# with the header of its own file; every cleaned row is tagged with its file in the SOURCE_COLUMN column, and the
+# rows of all files are combined in file order into one cleaned output.
+
+# Compressed files: raw files ending in .gz, .bz2 or .zst are decompressed in a background thread that feeds the csv
+# parser through a pipe, in every mode (parallel mode reads each compressed file as one shard); --compress CODEC
+# writes the cleaned csv file (and the rejects file) compressed with gzip, bz2 or zstd.
+
+# Overlapped streaming (--overlap QUEUE_SIZE): reading the next chunk, validating the current one and writing the
+# previous one run in separate threads connected by bounded queues; the utilization of each stage is reported.
+
+# Threaded rules (--threads N): the independent rule groups of steps 5-16 run concurrently on a thread pool, respecting
+# their dependencies (Units Returned after Units Sold, Revenue after Units Sold, Price and Discount); the critical path
+# time of the schedule is reported.
+
+# Instrumentation (--metrics-json, --metrics-prom): each of the steps below runs as a named stage that records wall
+# time, CPU time, peak RSS and tracemalloc deltas, written as JSON and optionally as a Prometheus textfile.
+
+# Validation cache (--validation-cache): the raw file is streamed in newline-aligned blocks whose digests are
+# remembered once they pass; later runs re-validate only new or changed blocks. The cache is keyed on a fingerprint
+# of the rule constants (allowed value lists, TOLERANCE, schema, RULESET_VERSION), so changing a rule invalidates it.
 
 # Imports
 from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Iterable, Iterator, Optional
+import argparse
+import ast
+import bz2
+import glob
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import queue
+import re
+import shutil
+import string
 import sys
+import tempfile
+import threading
+import time
+
+from instrumentation import stage, staged_iter
+from run_manifest import exit_if_unchanged, file_sha256, file_state, file_unchanged, write_run_manifest
+import instrumentation
+
+# Skip-if-unchanged fast path (--skip-unchanged): checked before pandas and numpy are imported, so a run with nothing
+# to do costs a few file stats
+if __name__ == "__main__":
+    exit_if_unchanged(Path(__file__))
+
 import pandas as pd
 import numpy as np
 
@@ -98,8 +201,123 @@ ALLOWED_PLATFORMS = {
     "Walmart"
 }
 
+# Allowed value list of each string column
+ALLOWED_VALUES = {
+    "Product Name": ALLOWED_PRODUCT_NAMES, 
+    "Category": ALLOWED_CATEGORIES, 
+    "Location": ALLOWED_LOCATIONS, 
+    "Platform": ALLOWED_PLATFORMS
+}
+
 TOLERANCE = 0.01
 
+# Expected data types of all columns after conversion of Date column
+EXPECTED_DTYPES = {
+    "Date": "datetime64[ns]", 
+    "Product Name": "object", 
+    "Category": "object", 
+    "Units Sold": "int64", 
+    "Price": "float64", 
+    "Revenue": "float64", 
+    "Discount": "float64", 
+    "Units Returned": "int64", 
+    "Location": "object", 
+    "Platform": "object"
+}
+
+# Fixed format of the raw Date column
+DATE_FORMAT = "%Y-%m-%d"
+
+# Version of the validation rules implemented by the validate_* functions; bump it whenever their logic changes so
+# that validation cache entries recorded under the old rules are discarded
+RULESET_VERSION = 1
+
+# Size of the newline-aligned blocks the raw file is hashed and validated in when the validation cache is used
+CACHE_BLOCK_BYTES = 64 * 1024 * 1024
+
+# Number of sampled row indices per rule in a violation report
+REPORT_SAMPLE_ROWS = 10
+
+# Row-level rules whose failing rows are moved to the rejects file in quarantine mode instead of failing the run
+QUARANTINE_RULES = {
+    "missing_or_blank",
+    "value_not_allowed",
+    "units_returned_missing",
+    "units_returned_non_integer",
+    "units_returned_negative",
+    "units_returned_exceed_sold",
+    "price_missing",
+    "price_non_positive",
+    "discount_missing",
+    "discount_out_of_range",
+    "revenue_no_formula_match",
+}
+
+# Column of the rejects file listing the failed rules of each rejected row
+REJECT_REASON_COLUMN = "Reject Reasons"
+
+# Default maximum share of rejected rows in quarantine mode; a higher reject rate fails the run
+MAX_REJECT_RATE = 0.001
+
+# Target size of one shard of the raw file in parallel mode; there are at least as many shards as workers, and
+# smaller shards keep the memory of each worker bounded
+SHARD_BYTES = 64 * 1024 * 1024
+
+# Compression codecs of raw and cleaned csv files: codec -> file suffix; zstd requires the zstandard package
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "bz2": ".bz2", "zstd": ".zst"}
+
+# Compression level of each codec for the cleaned output
+COMPRESSION_LEVELS = {"gzip": 6, "bz2": 9, "zstd": 3}
+
+# Size of the blocks the decompression thread hands to the csv parser
+DECOMPRESS_BLOCK_BYTES = 1024 * 1024
+
+# Raw files read from a directory given as --input, plain or compressed
+RAW_FILE_PATTERNS = ("*.csv", *(f"*.csv{suffix}" for suffix in COMPRESSION_SUFFIXES.values()))
+
+# Column added in multi-file mode (--input) with the raw file each cleaned row was read from
+SOURCE_COLUMN = "Source File"
+
+# Csv parsers available for reading the raw data file
+READER_ENGINES = ("c", "pyarrow", "python")
+
+# Output formats of the cleaned data; parquet and feather (Arrow IPC) files are written next to the cleaned csv file
+OUTPUT_FORMATS = ("csv", "parquet", "feather")
+
+# Columns besides year/week of Date that the partitioned output can additionally be split by
+PARTITION_COLUMNS = ("Location", "Platform")
+
+# Name of the manifest listing the partitions of the partitioned output
+MANIFEST_NAME = "manifest.json"
+
+# Rows per parquet row group; the cleaned data is ordered by Date, so the Date statistics of each row group let
+# readers skip row groups outside a date filter
+PARQUET_ROW_GROUP_ROWS = 1_048_576
+
+# Layout version of the parsed cache (--parsed-cache); a cache of another version is rebuilt
+PARSED_CACHE_VERSION = 1
+
+# Compact schema (--compact) of the numeric columns after validation; the string columns of ALLOWED_VALUES become
+# categoricals with int8 codes. Price, Revenue and Discount are checked to keep all COMPACT_DECIMALS decimal places.
+COMPACT_DTYPES = {
+    "Units Sold": "uint16",
+    "Units Returned": "uint8",
+    "Price": "float32",
+    "Revenue": "float32",
+    "Discount": "float32",
+}
+COMPACT_DECIMALS = 2
+
+# Temporary columns created while comparing revenue formulas (see notebook); dropped before the output is written
+TEMPORARY_COLUMNS = [
+    "Units x Price", 
+    "1 - Discount", 
+    "x Discount", 
+    "Comparison_1", 
+    "Comparison_2", 
+    "Comparison_3"
+]
+
 # Functions
 
 # Validate that the data frame contains all the required columns, raise an error if there are missing columns
@@ -111,49 +329,133 @@ def validate_schema(df: pd.DataFrame, required_columns: set) -> None:
             f"Schema validation failed. Missing required columns: {missing_columns}"
         )
 
-# Convert data type into datetime in Date column. 
-# Exit with error if conversion fails.
-def convert_date(df: pd.DataFrame) -> pd.DataFrame:
+# Parse date strings to datetimes through their distinct values: weekly data has one date string per week, so only
+# the unique strings are parsed and the results are broadcast back to the rows through their codes. Categorical
+# columns reuse their categories and codes. Invalid and missing values become NaT.
+def parse_dates_unique(values: pd.Series, date_format: Optional[str] = None) -> pd.Series:
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+    else:
+        codes, uniques = pd.factorize(values)
+    parsed = pd.to_datetime(pd.Series(uniques, dtype=object), format=date_format, errors="coerce")
+    # Code -1 (missing value) picks the NaT appended at the end
+    lookup = np.append(parsed.to_numpy(dtype="datetime64[ns]"), np.datetime64("NaT", "ns"))
+    return pd.Series(lookup[codes], index=values.index, name=values.name)
+
+# Convert data type into datetime in Date column, using the fixed date_format when one is given.
+# Exit with error if conversion fails, reporting the number of invalid or missing dates and a sample of their rows.
+def convert_date(df: pd.DataFrame, date_format: Optional[str] = None) -> pd.DataFrame:
     try:
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerse")
+        dates = parse_dates_unique(df["Date"], date_format)
     except Exception as e:
         raise ValueError(f"Date conversion failed with error: {e}")
-    
-    if df["Date"].isna().any():
-        raise ValueError("Data conversion failed: invalid or missing date values found.")
-    
+
+    invalid = dates.isna().to_numpy()
+    if invalid.any():
+        rows = df.index[invalid][:REPORT_SAMPLE_ROWS].tolist()
+        values = df["Date"][invalid].iloc[:REPORT_SAMPLE_ROWS].tolist()
+        raise ValueError(
+            f"Data conversion failed: {invalid.sum()} invalid or missing date values found, "
+            f"e.g. rows {rows} with values {values}."
+        )
+
+    df["Date"] = dates
     return df
 
+# Name of a column dtype for comparison with EXPECTED_DTYPES; arrow-backed dtypes (pyarrow reader engine) are named
+# after their numpy equivalent, and arrow strings count as object.
+def dtype_name(dtype) -> str:
+    if isinstance(dtype, pd.ArrowDtype):
+        if pd.api.types.is_string_dtype(dtype):
+            return "object"
+        return str(dtype.numpy_dtype)
+    return str(dtype)
+
 # Validate that all columns have the expected data types after conversion of Date column. 
+# String columns may be stored either as object or, when read by the typed reader, as category.
 # Exit with an error if any column has an unexpected data type.
 
 def validate_dtypes(df: pd.DataFrame) -> None:
-    expected_dtypes = {
-        "Date": "datetime64[ns]", 
-        "Product Name": "object", 
-        "Category": "object", 
-        "Units Sold": "int64", 
-        "Price": "float64", 
-        "Revenue": "float64", 
-        "Discount": "float64", 
-        "Units Returned": "int64", 
-        "Location": "object", 
-        "Platform": "object"
-    }
-
     mismatches = {}
 
-    for col, expected in expected_dtypes.items():
+    for col, expected in EXPECTED_DTYPES.items():
         if col not in df.columns:
             continue
 
-        actual = str(df[col].dtype)
+        actual = dtype_name(df[col].dtype)
+        if actual == "category" and expected == "object":
+            continue
         if actual != expected:
             mismatches[col] = {"expected": expected, "actual": actual}
     
     if mismatches:
         raise ValueError(f"Dtype validation failed: {mismatches}")
 
+# Dictionary-encode a column once (categorical columns already are): every row becomes an integer code into the
+# unique values. Normalization, blank detection and the membership check run on the unique values only, and the
+# results are mapped back to the rows through the codes in a single integer pass.
+# Returns the row mask of missing / blank values, the row mask of values outside the allowed list (blanks excluded)
+# and the sorted list of those invalid values.
+def allowed_value_masks(series: pd.Series, allowed_values: set, normalize: bool = True) -> tuple:
+    # Integer codes per row (-1 for missing values) and the unique values they point to
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+        uniques = pd.Series(series.cat.categories)
+    else:
+        codes, uniques = pd.factorize(series, use_na_sentinel=True)
+        uniques = pd.Series(uniques)
+
+    #Normalize strings, trim whitespace
+    if normalize and (pd.api.types.is_object_dtype(uniques) or pd.api.types.is_string_dtype(uniques)):
+        uniques = uniques.astype("string").str.strip()
+
+    # Treat empty strings as missing
+    blank_uniques = np.zeros(len(uniques), dtype=bool)
+    if pd.api.types.is_string_dtype(uniques):
+        blank_uniques = (uniques == "").to_numpy(dtype=bool, na_value=False)
+
+    # Unique values outside the allowed list; categories no row uses are ignored
+    used_uniques = np.bincount(codes[codes >= 0], minlength=len(uniques)) > 0
+    invalid_uniques = ~uniques.isin(allowed_values).to_numpy(dtype=bool) & ~blank_uniques & used_uniques
+
+    # Map back to rows; the extra last entry of each lookup table is the one code -1 (missing value) selects
+    empty_as_na = np.append(blank_uniques, True)[codes]
+    if invalid_uniques.any():
+        invalid_mask = np.append(invalid_uniques, False)[codes]
+    else:
+        invalid_mask = np.zeros(len(codes), dtype=bool)
+    invalid_values = sorted(set(uniques[invalid_uniques].astype(str)))
+
+    return empty_as_na, invalid_mask, invalid_values
+
+# Trim the whitespace of the string columns of allowed_values after validation, the same normalization
+# allowed_value_masks applies before its membership check, so a value that passed as "UK " is written as "UK" by every
+# output (csv, the columnar dictionaries, the compact categories and the partition folders). Works on the unique
+# values (the categories of a categorical column); columns without padded values are left as they are.
+def normalize_allowed_columns(df: pd.DataFrame, allowed_values: dict = ALLOWED_VALUES) -> pd.DataFrame:
+    normalized = {}
+    for col in allowed_values:
+        if col not in df.columns:
+            continue
+        series = df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            categories = list(series.cat.categories)
+            stripped = [value.strip() if isinstance(value, str) else value for value in categories]
+            if stripped == categories:
+                continue
+            new_categories = pd.Index(pd.unique(pd.Series(stripped, dtype=object)))
+            lookup = np.append(new_categories.get_indexer(stripped), -1)
+            codes = lookup[series.cat.codes.to_numpy()]
+            normalized[col] = pd.Categorical.from_codes(codes, categories=new_categories)
+        else:
+            padded = {
+                value: value.strip() for value in series.dropna().unique()
+                if isinstance(value, str) and value != value.strip()
+            }
+            if padded:
+                normalized[col] = series.replace(padded)
+    return df.assign(**normalized) if normalized else df
+
 # Validate that each value in each column belong to the list of allowed values. If not, raise an error.
 def validate_allowed_values(
         df: pd.DataFrame,
@@ -166,19 +468,10 @@ def validate_allowed_values(
     if column not in df.columns:
         raise ValueError(f"Allowed values validation failed: column '{column}' not found.")
     
-    series = df[column]
-
-    #Normalize strings, trim whitespace
-    if normalize and od.api.types.is_object_dtype(series):
-        series = series.astype("string").str.strip()
-
-    # Treat empty strings as missing
-    empty_as_na = series.isna()
-    if pd.api.types.is_string_dtype(series):
-        empty_as_na = empty_as_na | (series == "")
+    empty_as_na, invalid_mask, invalid_values = allowed_value_masks(df[column], allowed_values, normalize)
 
     if not allow_null:
-        if empty_as_na.amy():
+        if empty_as_na.any():
             bad_rows = df.loc[empty_as_na, [column]].head(10)
             raise ValueError(
                 f"Allowed values validation failed for '{column}':" 
@@ -186,12 +479,8 @@ def validate_allowed_values(
             ) 
         
     # Validate only non-missing values
-    to_check = series[~empty_as_na] if allow_null else series
-
-    invalid_mask = ~to_check.isin(allowed_values)
     if invalid_mask.any():
-        invalid_values = sorted(set(to_check[invalid_mask].astype(str).unique()))
-        examples = df.loc[to_check.index[invalid_mask], [colum]].head(10)
+        examples = df.loc[invalid_mask, [column]].head(10)
 
         raise ValueError(
             f"Allowed values validation failed for '{column}'."
@@ -199,10 +488,115 @@ def validate_allowed_values(
             f"Example rows:\n{examples.to_string(index=True)}"
         )
 
+# Blocked expression engine for compound row expressions (cross-column rules): expressions are evaluated over
+# EXPRESSION_BLOCK_ROWS rows at a time into block-sized buffers that are allocated once and reused for every block,
+# so no operator creates a full-length temporary. Trees are those of parse_rule_expression, extended with predicates:
+# (op, left, right) for the comparisons <, <=, >, >=, ==, !=, ("close", left, right, atol) for np.isclose with the
+# default relative tolerance, ("or", left, right), ("and", left, right) and ("not", operand).
+EXPRESSION_BLOCK_ROWS = 16384
+
+# Numpy ufuncs of the operators of the blocked expression engine
+BLOCK_ARITHMETIC_UFUNCS = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide}
+BLOCK_PREDICATE_UFUNCS = {
+    "<": np.less,
+    "<=": np.less_equal,
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "==": np.equal,
+    "!=": np.not_equal,
+    "or": np.logical_or,
+    "and": np.logical_and,
+}
+
+# Numpy arrays of the columns an expression reads. Numpy-backed numeric columns are used in place (no copy); other
+# columns (arrow-backed, nullable) are converted to float64 with NaN for missing values.
+def expression_arrays(df: pd.DataFrame, columns) -> dict:
+    arrays = {}
+    for column in columns:
+        series = df[column]
+        if isinstance(series.dtype, np.dtype) and series.dtype.kind in "iuf":
+            arrays[column] = series.to_numpy()
+        else:
+            arrays[column] = series.to_numpy(dtype=np.float64, na_value=np.nan)
+    return arrays
+
+# Evaluate an expression or predicate tree on rows start:stop. buffers maps each node to its block buffer (allocated
+# on first use); a node shared by several parts of the tree is computed once per block, tracked in done.
+def evaluate_block(tree: tuple, arrays: dict, start: int, stop: int, buffers: dict, done: set, block_rows: int):
+    kind = tree[0]
+    if kind == "column":
+        return arrays[tree[1]][start:stop]
+    if kind == "number":
+        return tree[1]
+    n = stop - start
+    if tree in done:
+        return buffers[tree][:n]
+
+    is_predicate = kind in BLOCK_PREDICATE_UFUNCS or kind in ("close", "not")
+    if tree not in buffers:
+        buffers[tree] = np.empty(block_rows, dtype=bool if is_predicate else np.float64)
+    out = buffers[tree][:n]
+
+    if kind == "neg":
+        np.negative(evaluate_block(tree[1], arrays, start, stop, buffers, done, block_rows), out=out)
+    elif kind == "not":
+        np.logical_not(evaluate_block(tree[1], arrays, start, stop, buffers, done, block_rows), out=out)
+    elif kind == "close":
+        # |a - b| <= atol + rtol * |b|, as np.isclose with rtol=1e-05; the scratch buffer is shared by all close nodes
+        a = evaluate_block(tree[1], arrays, start, stop, buffers, done, block_rows)
+        b = evaluate_block(tree[2], arrays, start, stop, buffers, done, block_rows)
+        if "close_scratch" not in buffers:
+            buffers["close_scratch"] = (np.empty(block_rows), np.empty(block_rows))
+        difference, limit = (buffer[:n] for buffer in buffers["close_scratch"])
+        np.subtract(a, b, out=difference)
+        np.abs(difference, out=difference)
+        np.abs(b, out=limit)
+        limit *= 1e-05
+        limit += tree[3]
+        np.less_equal(difference, limit, out=out)
+    else:
+        ufunc = BLOCK_ARITHMETIC_UFUNCS.get(kind) or BLOCK_PREDICATE_UFUNCS[kind]
+        left = evaluate_block(tree[1], arrays, start, stop, buffers, done, block_rows)
+        right = evaluate_block(tree[2], arrays, start, stop, buffers, done, block_rows)
+        ufunc(left, right, out=out)
+
+    done.add(tree)
+    return out
+
+# Count the rows for which a predicate tree holds, evaluating it block by block. With out (a boolean array of n_rows)
+# the per-row result is stored as well.
+def count_blocked(
+        tree: tuple,
+        arrays: dict,
+        n_rows: int,
+        out: Optional[np.ndarray] = None,
+        block_rows: int = EXPRESSION_BLOCK_ROWS
+) -> int:
+    buffers = {}
+    count = 0
+    for start in range(0, n_rows, block_rows):
+        stop = min(start + block_rows, n_rows)
+        result = evaluate_block(tree, arrays, start, stop, buffers, set(), block_rows)
+        count += int(np.count_nonzero(result))
+        if out is not None:
+            out[start:stop] = result
+    return count
+
+# Predicate tree of rows whose Revenue matches none of the three revenue formulas within tolerance
+def revenue_mismatch_tree(tolerance: float) -> tuple:
+    revenue = parse_rule_expression("[Revenue]")
+    formulas = [
+        parse_rule_expression("[Units Sold] * [Price]"),
+        parse_rule_expression("[Units Sold] * [Price] * (1 - [Discount])"),
+        parse_rule_expression("[Units Sold] * [Price] * [Discount]"),
+    ]
+    f1, f2, f3 = (("close", revenue, formula, tolerance) for formula in formulas)
+    return "not", ("or", ("or", f1, f2), f3)
+
 # Validating Units Sold column, checking missing values, all values are integers and non-negative
 def validate_sold_units(df: pd.DataFrame) -> None:
 
-    coumn = "Units Sold"
+    column = "Units Sold"
 
     if column not in df.columns:
         raise ValueError(f"Units Sold validation failed: column'{column}' is missing")
@@ -210,7 +604,8 @@ def validate_sold_units(df: pd.DataFrame) -> None:
     if df[column].isna().any():
         raise ValueError("Units Sold validation failed: missing value found")
     
-    if not (df[column] % 1 == 0).all():
+    # Integer columns (numpy or arrow-backed) hold only whole numbers, the modulo check is needed for floats only
+    if not pd.api.types.is_integer_dtype(df[column]) and not (df[column] % 1 == 0).all():
         raise ValueError("Units Sold validation failed: non-integer values found.")
     
     if (df[column] < 0).any():
@@ -231,13 +626,15 @@ def validate_units_returned(df: pd.DataFrame) -> None:
     if df[column].isna().any():
         raise ValueError("Units Returned validation failed: missing values found.")
     
-    if not (df[column] % 1 == 0).all():
+    # Integer columns (numpy or arrow-backed) hold only whole numbers, the modulo check is needed for floats only
+    if not pd.api.types.is_integer_dtype(df[column]) and not (df[column] % 1 == 0).all():
         raise ValueError("Units Returned validation failed: non-integer values found.")
     
     if (df[column] < 0).any():
         raise ValueError("Units Returned validation failed: negative values found.")
     
-    if (df[column] > df[sold_column]).any():
+    exceeds = (">", ("column", column), ("column", sold_column))
+    if count_blocked(exceeds, expression_arrays(df, [column, sold_column]), len(df)):
         raise ValueError("Units Returned validation failed: returned units exceed sold units.")
 
 # Validating Price column, column must exist, no missing values, values numeric and positive
@@ -281,25 +678,2573 @@ def validate_revenue(df: pd.DataFrame, tolerance: float) -> None:
     if missing:
         raise ValueError(f"Revenue validation failed: missing required columns {missing}")
     
-    revenue_f1 = df["Units Sold"] * df["price"]
-    revenue_f2 = df["Units Sold"] * df["Price"] * (1 - df["Discount"])
-    revenue_f3 = df["Units Sold"] * df["Price"] * df["Discount"]
+    # The three formulas and their comparisons run block by block (see count_blocked); Units Sold * Price is computed
+    # once per block for all three formulas
+    failed_count = count_blocked(revenue_mismatch_tree(tolerance), expression_arrays(df, required_columns), len(df))
+    if failed_count:
+        raise ValueError(f"Revenue validation failed: {failed_count} rows do not match any valid formula")
+    
+# Exact revenue check in fixed point: Price and Revenue as int64 cents, Discount as int64 basis points (1/10000).
+# Every formula becomes one integer comparison against the tolerance in whole cents, scaled by 10000 for the
+# discounted formulas so that no division is needed; there is no float drift and no relative tolerance, so large
+# revenues are held to the same cent tolerance as small ones. Exact for values with at most two (Price, Revenue) and
+# four (Discount) decimal places and revenues below about 9e12. Missing values never match.
+# Returns a boolean numpy array that is True for rows matching none of the three formulas.
+def revenue_mismatch_cents(sold, price, discount, revenue, tolerance: float) -> np.ndarray:
+    columns = [np.asarray(values) for values in (sold, price, discount, revenue)]
+    missing = np.zeros(len(columns[0]), dtype=bool)
+    for values in columns:
+        if np.issubdtype(values.dtype, np.floating):
+            missing |= np.isnan(values)
+    has_missing = missing.any()
+
+    def to_fixed(values: np.ndarray, scale: int) -> np.ndarray:
+        scaled = values * float(scale)
+        if has_missing:
+            scaled[missing] = 0.0
+        np.rint(scaled, out=scaled)
+        return scaled.astype(np.int64)
+
+    tolerance_cents = round(tolerance * 100)
+    gross_cents = to_fixed(columns[0], 1)
+    gross_cents *= to_fixed(columns[1], 100)
+    revenue_cents = to_fixed(columns[3], 100)
+    discount_bp = to_fixed(columns[2], 10000)
+
+    work = revenue_cents - gross_cents
+    np.abs(work, out=work)
+    match = work <= tolerance_cents
+
+    # Discounted formulas, scaled by 10000: |revenue * 10000 - gross * (10000 - discount)| and |... - gross * discount|
+    revenue_cents *= 10000
+    np.multiply(gross_cents, discount_bp, out=work)
+    np.subtract(revenue_cents, work, out=discount_bp)
+    np.abs(discount_bp, out=discount_bp)
+    match |= discount_bp <= tolerance_cents * 10000
+    # gross * (10000 - discount) = gross * 10000 - gross * discount
+    gross_cents *= 10000
+    gross_cents -= work
+    revenue_cents -= gross_cents
+    np.abs(revenue_cents, out=revenue_cents)
+    match |= revenue_cents <= tolerance_cents * 10000
+
+    return ~match | missing
+
+# Exact mode replacement for validate_revenue, based on revenue_mismatch_cents
+def validate_revenue_exact(df: pd.DataFrame, tolerance: float) -> None:
+    required_columns = {"Revenue", "Units Sold", "Price", "Discount"}
+    missing = required_columns - set(df.columns)
+    if missing:
+        raise ValueError(f"Revenue validation failed: missing required columns {missing}")
 
-    match_f1 = np.isclose(df["Revenue"], revenue_f1, atol=tolerance)
-    match_f2 = np.isclose(df["Revenue"], revenue_f2, atol=tolerance)
-    match_f3 = np.isclose(df["Revenue"], revenue_f3, atol=tolerance)
+    mismatch = revenue_mismatch_cents(
+        df["Units Sold"].to_numpy(), df["Price"].to_numpy(), df["Discount"].to_numpy(), df["Revenue"].to_numpy(),
+        tolerance,
+    )
+    if mismatch.any():
+        raise ValueError(f"Revenue validation failed: {mismatch.sum()} rows do not match any valid formula")
 
-    valid_rows = match_f1 | match_f2 | match_f3
 
-    if not valid_rows.all():
-        failed_count = (~valid_rows).sum()
+# Candidate revenue formulas of steps 11-14, in the order of validate_revenue
+REVENUE_FORMULAS = ("units_x_price", "units_x_price_x_(1-discount)", "units_x_price_x_discount")
+
+# Rows sampled (evenly spaced over the data frame) to infer the dominant revenue formula
+FORMULA_SAMPLE_ROWS = 1000
+
+# Expected revenue of one formula
+def revenue_formula(name: str, sold: np.ndarray, price: np.ndarray, discount: np.ndarray) -> np.ndarray:
+    if name == "units_x_price":
+        return sold * price
+    if name == "units_x_price_x_(1-discount)":
+        return sold * price * (1 - discount)
+    return sold * price * discount
+
+# Evaluate the revenue formulas in the given order, each one only on the rows no earlier formula matched; when the
+# first formula holds for every row the others are never evaluated. Returns an int8 numpy array with the position in
+# REVENUE_FORMULAS of the formula that matched each row, or -1 for rows that match none.
+def match_revenue_formulas(
+        sold: np.ndarray,
+        price: np.ndarray,
+        discount: np.ndarray,
+        revenue: np.ndarray,
+        tolerance: float,
+        order: tuple = REVENUE_FORMULAS
+) -> np.ndarray:
+    matched = np.full(len(revenue), -1, dtype=np.int8)
+    pending = None
+    for name in order:
+        if pending is None:
+            ok = np.isclose(revenue, revenue_formula(name, sold, price, discount), atol=tolerance)
+            matched[ok] = REVENUE_FORMULAS.index(name)
+            pending = np.flatnonzero(~ok)
+        else:
+            expected = revenue_formula(name, sold[pending], price[pending], discount[pending])
+            ok = np.isclose(revenue[pending], expected, atol=tolerance)
+            matched[pending[ok]] = REVENUE_FORMULAS.index(name)
+            pending = pending[~ok]
+        if len(pending) == 0:
+            break
+    return matched
+
+# Infer the order in which to try the revenue formulas: the formulas ranked by the number of sampled rows they match,
+# ties in the order of REVENUE_FORMULAS
+def infer_revenue_formula_order(
+        sold: np.ndarray,
+        price: np.ndarray,
+        discount: np.ndarray,
+        revenue: np.ndarray,
+        tolerance: float,
+        sample_rows: int = FORMULA_SAMPLE_ROWS
+) -> tuple:
+    if len(revenue) == 0:
+        return REVENUE_FORMULAS
+    sample = np.unique(np.linspace(0, len(revenue) - 1, min(sample_rows, len(revenue))).astype(np.int64))
+    s, p, d, r = sold[sample], price[sample], discount[sample], revenue[sample]
+    hits = {
+        name: np.isclose(r, revenue_formula(name, s, p, d), atol=tolerance).sum() for name in REVENUE_FORMULAS
+    }
+    return tuple(sorted(REVENUE_FORMULAS, key=lambda name: -hits[name]))
+
+# Integer codes and labels of a segment column; categorical columns reuse their codes, missing values get a label of
+# their own
+def segment_codes(series: pd.Series) -> tuple:
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy().astype(np.int64)
+        labels = list(series.cat.categories)
+        if (codes < 0).any():
+            codes[codes < 0] = len(labels)
+            labels.append(np.nan)
+        return codes, labels
+    codes, labels = pd.factorize(series, use_na_sentinel=False)
+    return codes.astype(np.int64), list(labels)
+
+# Count the rows per Platform / Location segment for which each revenue formula held ("none" when no formula did).
+# Returns a dict "platform|location|formula" -> rows, summed into the instrumentation totals across chunks and shards.
+def revenue_formula_stats(df: pd.DataFrame, matched: np.ndarray) -> dict:
+    platform_codes, platforms = segment_codes(df["Platform"])
+    location_codes, locations = segment_codes(df["Location"])
+    n_formulas = len(REVENUE_FORMULAS) + 1
+    keys = (platform_codes.astype(np.int64) * len(locations) + location_codes) * n_formulas + (matched + 1)
+    counts = np.bincount(keys, minlength=len(platforms) * len(locations) * n_formulas)
+
+    stats = {}
+    for key in np.flatnonzero(counts):
+        segment, formula = divmod(int(key), n_formulas)
+        platform, location = divmod(segment, len(locations))
+        name = REVENUE_FORMULAS[formula - 1] if formula else "none"
+        stats[f"{platforms[platform]}|{locations[location]}|{name}"] = int(counts[key])
+    return stats
+
+# Inferred replacement for validate_revenue: validate every row against the dominant formula of a sample first and
+# fall back to the other formulas only for the rows it does not match. The formula that held is counted per
+# Platform / Location segment in the "revenue_formulas" instrumentation totals.
+def validate_revenue_inferred(df: pd.DataFrame, tolerance: float) -> None:
+    required_columns = {"Revenue", "Units Sold", "Price", "Discount", "Platform", "Location"}
+    missing = required_columns - set(df.columns)
+    if missing:
+        raise ValueError(f"Revenue validation failed: missing required columns {missing}")
+
+    columns = [df[col].to_numpy(dtype=np.float64) for col in ("Units Sold", "Price", "Discount", "Revenue")]
+    order = infer_revenue_formula_order(*columns, tolerance)
+    matched = match_revenue_formulas(*columns, tolerance, order=order)
+    instrumentation.add_totals("revenue_formulas", revenue_formula_stats(df, matched))
+
+    failed_count = (matched < 0).sum()
+    if failed_count:
         raise ValueError(f"Revenue validation failed: {failed_count} rows do not match any valid formula")
-    
 
-drop_temporary_columns(df)
-validate_missing_required(df, required_columns)
-write_clean_csv(df, out_path)
+# Fused validation engine for the numeric rules of validate_sold_units, validate_units_returned, validate_price,
+# validate_discount and validate_revenue. Each column buffer is read once, in blocks of FUSED_BLOCK_ROWS rows, and
+# every row-level predicate is evaluated on the block while it is in cache, into a block-sized buffer per rule that is
+# reused for every block. Temporaries only ever have the size of a block, never the size of the data frame. The
+# revenue formulas run on the blocked expression engine (revenue_mismatch_tree), so Units Sold x Price is computed once
+# per block for all three formulas.
+FUSED_BLOCK_ROWS = 65536
+
+# Fused rules in the same order as the sequential validators, with the error raised for the first failing rule
+FUSED_RULES = {
+    "units_sold_missing": "Units Sold validation failed: missing value found",
+    "units_sold_non_integer": "Units Sold validation failed: non-integer values found.",
+    "units_sold_negative": "Units Sold validation failed: negative values found.",
+    "units_returned_missing": "Units Returned validation failed: missing values found.",
+    "units_returned_non_integer": "Units Returned validation failed: non-integer values found.",
+    "units_returned_negative": "Units Returned validation failed: negative values found.",
+    "units_returned_exceed_sold": "Units Returned validation failed: returned units exceed sold units.",
+    "price_missing": "Price validation failed: missing values found.",
+    "price_non_positive": "Price validation failed: zero or negative values found.",
+    "discount_missing": "Discount column validation failed: missing values found.",
+    "discount_out_of_range": "Discount column validation failed: values outside range 0... 1 found.",
+    "revenue_no_formula_match": "Revenue validation failed: {count} rows do not match any valid formula",
+}
+
+# Columns each fused rule reads besides the column it checks (FUSED_RULE_COLUMNS); in collect-all mode a rule runs
+# only when all of them are present
+FUSED_RULE_INPUTS = {
+    "units_returned_exceed_sold": {"Units Sold"},
+    "revenue_no_formula_match": {"Units Sold", "Price", "Discount"},
+}
+
+# Column each fused rule checks, for violation reports
+FUSED_RULE_COLUMNS = {
+    "units_sold_missing": "Units Sold",
+    "units_sold_non_integer": "Units Sold",
+    "units_sold_negative": "Units Sold",
+    "units_returned_missing": "Units Returned",
+    "units_returned_non_integer": "Units Returned",
+    "units_returned_negative": "Units Returned",
+    "units_returned_exceed_sold": "Units Returned",
+    "price_missing": "Price",
+    "price_non_positive": "Price",
+    "discount_missing": "Discount",
+    "discount_out_of_range": "Discount",
+    "revenue_no_formula_match": "Revenue",
+}
+
+# Count the violations of every fused rule in a single blocked pass over the numeric columns. Each rule is evaluated
+# into a block-sized buffer and counted there, so a run over clean data holds no full-length array. With keep_masks
+# the violation bitmask of every rule that fires is kept as well; it is allocated at the rule's first violating block.
+# Returns (counts, masks): dict rule name -> violating rows, and dict rule name -> boolean numpy array (True marks a
+# violating row) for the rules that fire, in FUSED_RULES order.
+# With exact_revenue the revenue rule uses the fixed-point comparison of revenue_mismatch_cents.
+def count_fused_violations(
+        df: pd.DataFrame,
+        tolerance: float,
+        exact_revenue: bool = False,
+        keep_masks: bool = False
+) -> tuple:
+    required_columns = ["Units Sold", "Units Returned", "Price", "Discount", "Revenue"]
+    missing = set(required_columns) - set(df.columns)
+    if missing:
+        raise ValueError(f"Fused validation failed: missing required columns {missing}")
+
+    for col in required_columns:
+        if not pd.api.types.is_numeric_dtype(df[col]):
+            raise ValueError(f"Fused validation failed: non-numeric values found in '{col}'.")
+
+    sold = df["Units Sold"].to_numpy()
+    returned = df["Units Returned"].to_numpy()
+    price = df["Price"].to_numpy()
+    discount = df["Discount"].to_numpy()
+    revenue = df["Revenue"].to_numpy()
+
+    # Integer columns can hold neither missing nor fractional values, so those predicates are skipped for them (their
+    # block buffers stay all False)
+    sold_is_float = np.issubdtype(sold.dtype, np.floating)
+    returned_is_float = np.issubdtype(returned.dtype, np.floating)
+
+    n_rows = len(df)
+    counts = dict.fromkeys(FUSED_RULES, 0)
+    masks = {}
+    blocks = {rule: np.zeros(FUSED_BLOCK_ROWS, dtype=bool) for rule in FUSED_RULES}
+    fraction = np.empty(FUSED_BLOCK_ROWS)
+    flags = np.empty(FUSED_BLOCK_ROWS, dtype=bool)
+    revenue_tree = revenue_mismatch_tree(tolerance)
+
+    # Missing and non-integer predicates of a float column, written into the block buffers
+    def check_whole_numbers(values: np.ndarray, missing_rule: str, non_integer_rule: str, n: int) -> None:
+        missing = blocks[missing_rule][:n]
+        non_integer = blocks[non_integer_rule][:n]
+        np.isnan(values, out=missing)
+        np.fmod(values, 1, out=fraction[:n])
+        np.not_equal(fraction[:n], 0, out=non_integer)
+        np.logical_not(missing, out=flags[:n])
+        non_integer &= flags[:n]
+
+    for start in range(0, n_rows, FUSED_BLOCK_ROWS):
+        stop = min(start + FUSED_BLOCK_ROWS, n_rows)
+        n = stop - start
+        s = sold[start:stop]
+        r = returned[start:stop]
+        p = price[start:stop]
+        d = discount[start:stop]
+
+        if sold_is_float:
+            check_whole_numbers(s, "units_sold_missing", "units_sold_non_integer", n)
+        np.less(s, 0, out=blocks["units_sold_negative"][:n])
+
+        if returned_is_float:
+            check_whole_numbers(r, "units_returned_missing", "units_returned_non_integer", n)
+        np.less(r, 0, out=blocks["units_returned_negative"][:n])
+        np.greater(r, s, out=blocks["units_returned_exceed_sold"][:n])
+
+        np.isnan(p, out=blocks["price_missing"][:n])
+        np.less_equal(p, 0, out=blocks["price_non_positive"][:n])
+
+        np.isnan(d, out=blocks["discount_missing"][:n])
+        out_of_range = blocks["discount_out_of_range"][:n]
+        np.less(d, 0, out=out_of_range)
+        np.greater(d, 1, out=flags[:n])
+        out_of_range |= flags[:n]
+
+        rev = revenue[start:stop]
+        if exact_revenue:
+            blocks["revenue_no_formula_match"][:n] = revenue_mismatch_cents(s, p, d, rev, tolerance)
+        else:
+            arrays = {"Units Sold": s, "Price": p, "Discount": d, "Revenue": rev}
+            count_blocked(revenue_tree, arrays, n, out=blocks["revenue_no_formula_match"][:n])
+
+        for rule, block in blocks.items():
+            count = int(np.count_nonzero(block[:n]))
+            if count:
+                counts[rule] += count
+                if keep_masks:
+                    if rule not in masks:
+                        masks[rule] = np.zeros(n_rows, dtype=bool)
+                    masks[rule][start:stop] = block[:n]
+
+    return counts, {rule: masks[rule] for rule in FUSED_RULES if rule in masks}
+
+# Violation bitmasks of the fused rules that fire, as used by collect-all and quarantine mode
+def compute_fused_violations(df: pd.DataFrame, tolerance: float, exact_revenue: bool = False) -> dict:
+    return count_fused_violations(df, tolerance, exact_revenue=exact_revenue, keep_masks=True)[1]
+
+# Drop-in replacement for the sequence validate_sold_units ... validate_revenue: counts the violations of all rules in
+# one pass and raises the same error as the sequential path for the first failing rule.
+def validate_numeric_fused(df: pd.DataFrame, tolerance: float, exact_revenue: bool = False) -> None:
+    counts, _ = count_fused_violations(df, tolerance, exact_revenue=exact_revenue)
+
+    for rule, message in FUSED_RULES.items():
+        if counts[rule]:
+            raise ValueError(message.format(count=counts[rule]))
+
+# Declarative rule plan (--rules): checks of a rule spec file (see scripts/rules.toml) and their relative cost per row,
+# used to evaluate cheap checks first
+RULE_CHECK_COST = {
+    "not_missing": 1,
+    "range": 1,
+    "compare": 2,
+    "integer": 3,
+    "allowed": 4,
+    "formula": 4,
+}
+
+# Operators of the compare check and of rule expressions; both are evaluated by the blocked expression engine
+RULE_COMPARE_OPS = ("<", "<=", ">", ">=", "==", "!=")
+RULE_EXPRESSION_OPS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/"}
+
+# Placeholders a rule message can use
+RULE_MESSAGE_FIELDS = {"count", "column", "values", "examples"}
+
+# Load a rule spec file (TOML) as a dict with a list of rules under "rule"
+def load_rule_spec(path: Path) -> dict:
+    import tomllib
+
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+# Parse a rule expression such as "[Units Sold] * [Price] * (1 - [Discount])" into a tree of hashable tuples:
+# ("column", name), ("number", value), ("neg", operand) or (operator, left, right). Operands of + and * are sorted,
+# so equal sub-expressions written in a different order get the same tree and are computed once.
+def parse_rule_expression(text: str) -> tuple:
+    columns = []
+
+    def placeholder(match) -> str:
+        columns.append(match.group(1))
+        return f"_column_{len(columns) - 1}"
+
+    try:
+        tree = ast.parse(re.sub(r"\[([^\]]+)\]", placeholder, text), mode="eval").body
+    except SyntaxError as e:
+        raise ValueError(f"Rule spec failed: invalid expression '{text}': {e.msg}.")
+
+    def build(node) -> tuple:
+        if isinstance(node, ast.BinOp) and type(node.op) in RULE_EXPRESSION_OPS:
+            op = RULE_EXPRESSION_OPS[type(node.op)]
+            left, right = build(node.left), build(node.right)
+            if op in ("+", "*"):
+                left, right = sorted((left, right), key=repr)
+            return op, left, right
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return "neg", build(node.operand)
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return "number", float(node.value)
+        if isinstance(node, ast.Name) and node.id.startswith("_column_"):
+            return "column", columns[int(node.id[len("_column_"):])]
+        raise ValueError(f"Rule spec failed: unsupported syntax in expression '{text}'.")
+
+    return build(tree)
+
+# Columns referenced by an expression tree
+def expression_columns(tree: tuple) -> set:
+    if tree[0] == "column":
+        return {tree[1]}
+    if tree[0] == "number":
+        return set()
+    return set().union(*(expression_columns(operand) for operand in tree[1:]))
+
+# Check that a setting of a rule is a number (bools are not), for the bounds and tolerances of a rule spec
+def check_rule_number(rule: dict, key: str) -> None:
+    value = rule[key]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"Rule spec failed: {key} of rule '{rule['name']}' is not a number: {value!r}.")
+
+# Check that a rule message is a format string using only RULE_MESSAGE_FIELDS, so that a failing rule can always
+# format its error
+def check_rule_message(rule: dict) -> None:
+    message = rule["message"]
+    if not isinstance(message, str):
+        raise ValueError(f"Rule spec failed: message of rule '{rule['name']}' is not a string.")
+    try:
+        fields = [
+            re.split(r"[.\[]", field)[0] for _, field, _, _ in string.Formatter().parse(message) if field is not None
+        ]
+    except ValueError as e:
+        raise ValueError(f"Rule spec failed: invalid message of rule '{rule['name']}': {e}.")
+    unknown = sorted(set(fields) - RULE_MESSAGE_FIELDS)
+    if unknown:
+        raise ValueError(
+            f"Rule spec failed: message of rule '{rule['name']}' uses unknown placeholders {unknown}, "
+            f"expected some of {sorted(RULE_MESSAGE_FIELDS)}."
+        )
+
+# Number of arithmetic operations of an expression tree
+def expression_size(tree: tuple) -> int:
+    if tree[0] in ("column", "number"):
+        return 0
+    return 1 + sum(expression_size(operand) for operand in tree[1:])
+
+# Compile a rule spec into an execution plan. Every rule is checked and normalized (settings present and of the right
+# type, messages using known placeholders only), expressions are parsed, and the
+# rules are batched per column (cross-column rules per set of columns); batches run cheapest first and within a batch
+# the cheapest rule runs first. Rules keep their position in the spec, which decides which error is raised when
+# several rules fail. Raises ValueError for an invalid spec.
+def compile_rule_plan(spec: dict) -> dict:
+    rules = []
+    for position, entry in enumerate(spec.get("rule", [])):
+        rule = dict(entry)
+        name = rule.get("name")
+        check = rule.get("check")
+        if not name:
+            raise ValueError(f"Rule spec failed: rule {position + 1} has no name.")
+        if check not in RULE_CHECK_COST:
+            raise ValueError(f"Rule spec failed: rule '{name}' has unknown check '{check}'.")
+        if any(other["name"] == name for other in rules):
+            raise ValueError(f"Rule spec failed: rule name '{name}' is used more than once.")
+        rule.setdefault("message", f"Rule {name} failed: {{count}} rows.")
+        check_rule_message(rule)
+
+        if check == "compare":
+            if rule.get("op") not in RULE_COMPARE_OPS:
+                raise ValueError(f"Rule spec failed: rule '{name}' has unknown operator '{rule.get('op')}'.")
+            for side in ("left", "right"):
+                if not isinstance(rule.get(side), str):
+                    raise ValueError(f"Rule spec failed: compare rule '{name}' has no {side} expression.")
+            rule["left"] = parse_rule_expression(rule["left"])
+            rule["right"] = parse_rule_expression(rule["right"])
+            rule["columns"] = sorted(expression_columns(rule["left"]) | expression_columns(rule["right"]))
+            cost = RULE_CHECK_COST[check] + expression_size(rule["left"]) + expression_size(rule["right"])
+        else:
+            if not rule.get("column"):
+                raise ValueError(f"Rule spec failed: rule '{name}' has no column.")
+            rule["columns"] = [rule["column"]]
+            cost = RULE_CHECK_COST[check]
+            if check == "allowed":
+                values = rule.get("values")
+                if not isinstance(values, list) or not values or not all(isinstance(v, str) for v in values):
+                    raise ValueError(f"Rule spec failed: allowed rule '{name}' needs a list of text values.")
+                rule["values"] = set(values)
+            elif check == "range":
+                if "min" not in rule and "max" not in rule:
+                    raise ValueError(f"Rule spec failed: range rule '{name}' has neither min nor max.")
+                for bound in ("min", "max"):
+                    if bound in rule:
+                        check_rule_number(rule, bound)
+                cost += ("min" in rule) + ("max" in rule) - 1
+            elif check == "formula":
+                any_of = rule.get("any_of")
+                if not isinstance(any_of, list) or not any_of or not all(isinstance(text, str) for text in any_of):
+                    raise ValueError(f"Rule spec failed: formula rule '{name}' has no any_of expressions.")
+                rule["any_of"] = [parse_rule_expression(text) for text in any_of]
+                rule.setdefault("tolerance", 0.0)
+                check_rule_number(rule, "tolerance")
+                if rule["tolerance"] < 0:
+                    raise ValueError(f"Rule spec failed: tolerance of formula rule '{name}' is negative.")
+                rule["tolerance"] = float(rule["tolerance"])
+                for tree in rule["any_of"]:
+                    rule["columns"] = sorted(set(rule["columns"]) | expression_columns(tree))
+                cost += sum(expression_size(tree) + 1 for tree in rule["any_of"])
+
+        rule["position"] = position
+        rule["cost"] = cost
+        rules.append(rule)
+
+    batches = {}
+    for rule in rules:
+        key = rule["column"] if rule["check"] != "compare" and len(rule["columns"]) == 1 else ", ".join(rule["columns"])
+        batches.setdefault(key, []).append(rule["position"])
+    batches = sorted(
+        ({"columns": key, "rules": sorted(positions, key=lambda p: rules[p]["cost"])} for key, positions in batches.items()),
+        key=lambda batch: (sum(rules[p]["cost"] for p in batch["rules"]), batch["rules"][0]),
+    )
+
+    # The allowed values of each text column, so its codes are computed once for its not_missing and allowed rules
+    allowed = {rule["column"]: rule["values"] for rule in rules if rule["check"] == "allowed"}
+
+    return {
+        "rules": rules,
+        "batches": batches,
+        "order": [position for batch in batches for position in batch["rules"]],
+        "allowed": allowed,
+        "columns": sorted(set().union(*(rule["columns"] for rule in rules))),
+        "digest": hashlib.sha256(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest(),
+    }
+
+# Allowed values of the string columns of ALLOWED_VALUES under a rule plan: the values of the plan's allowed rule for
+# each column it checks, the built-in list for the others. These are the categories of the compact schema and of the
+# columnar outputs, so a value onboarded in the rule spec file is written like any other.
+def plan_allowed_values(rule_plan: Optional[dict]) -> dict:
+    if rule_plan is None:
+        return ALLOWED_VALUES
+    return {col: rule_plan["allowed"].get(col, values) for col, values in ALLOWED_VALUES.items()}
+
+# Violation predicate of a compare or formula rule as a tree of the blocked expression engine. A compare rule fails
+# where both sides are defined (not NaN, tested as x == x) and the comparison does not hold; a formula rule fails where
+# the column is close to none of its any_of expressions.
+def plan_rule_tree(rule: dict) -> tuple:
+    if rule["check"] == "compare":
+        left, right = rule["left"], rule["right"]
+        defined = ("and", ("==", left, left), ("==", right, right))
+        return "and", ("not", (rule["op"], left, right)), defined
+    column = ("column", rule["column"])
+    matches = [("close", column, tree, rule["tolerance"]) for tree in rule["any_of"]]
+    match = matches[0]
+    for other in matches[1:]:
+        match = ("or", match, other)
+    return "not", match
+
+# Count the arithmetic nodes of an expression tree into stats: each distinct node is evaluated once per block, and
+# every further occurrence reuses its buffer
+def count_plan_expressions(tree: tuple, stats: dict, seen: set) -> None:
+    if tree[0] in ("column", "number"):
+        return
+    if tree[0] in BLOCK_ARITHMETIC_UFUNCS or tree[0] == "neg":
+        if tree in seen:
+            stats["expressions_reused"] += 1
+            return
+        seen.add(tree)
+        stats["expressions_evaluated"] += 1
+    for operand in tree[1:]:
+        if isinstance(operand, tuple):
+            count_plan_expressions(operand, stats, seen)
+
+# Evaluate one compiled rule on a data frame. cache holds the values shared between rules of one evaluation: numeric
+# column arrays and the codes of text columns. Compare and formula rules run on the blocked expression engine
+# (count_blocked). Returns the violation mask and, for allowed rules, the invalid values.
+def evaluate_plan_rule(df: pd.DataFrame, plan: dict, rule: dict, cache: dict, stats: dict) -> tuple:
+    def numeric(column: str) -> np.ndarray:
+        key = ("column", column)
+        if key not in cache:
+            if not pd.api.types.is_numeric_dtype(df[column]):
+                raise ValueError(f"Rule {rule['name']} failed: non-numeric values found in '{column}'.")
+            if pd.api.types.is_integer_dtype(df[column]) and not df[column].hasnans:
+                cache[key] = df[column].to_numpy(dtype=np.int64)
+            else:
+                cache[key] = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        return cache[key]
+
+    def text_masks(column: str) -> tuple:
+        key = ("text", column)
+        if key not in cache:
+            cache[key] = allowed_value_masks(df[column], plan["allowed"].get(column, set()))
+        return cache[key]
+
+    check = rule["check"]
+    column = rule.get("column")
+    if check == "not_missing":
+        if pd.api.types.is_numeric_dtype(df[column]):
+            return df[column].isna().to_numpy(), None
+        return text_masks(column)[0], None
+    if check == "allowed":
+        _, invalid_mask, invalid_values = text_masks(column)
+        return invalid_mask, invalid_values
+    if check == "integer":
+        values = numeric(column)
+        if np.issubdtype(values.dtype, np.integer):
+            return np.zeros(len(values), dtype=bool), None
+        return (values % 1 != 0) & ~np.isnan(values), None
+    if check == "range":
+        values = numeric(column)
+        mask = np.zeros(len(values), dtype=bool)
+        if "min" in rule:
+            mask |= values < rule["min"] if rule.get("min_inclusive", True) else values <= rule["min"]
+        if "max" in rule:
+            mask |= values > rule["max"] if rule.get("max_inclusive", True) else values >= rule["max"]
+        return mask, None
+
+    tree = plan_rule_tree(rule)
+    count_plan_expressions(tree, stats, set())
+    mask = np.zeros(len(df), dtype=bool)
+    count_blocked(tree, {col: numeric(col) for col in rule["columns"]}, len(df), out=mask)
+    return mask, None
+
+# Replacement for steps 5-16 driven by a compiled rule plan. Rules run in plan order (cheapest first); once a rule
+# fails, only the rules listed before it in the spec are still evaluated, and the error of the first failing rule in
+# spec order is raised, as the hand-written validators would. Evaluated, skipped and shared work is added to the
+# "rule_plan" instrumentation totals.
+def validate_with_plan(df: pd.DataFrame, plan: dict) -> None:
+    missing = set(plan["columns"]) - set(df.columns)
+    if missing:
+        raise ValueError(f"Rule plan validation failed: missing required columns {missing}")
+
+    cache = {}
+    stats = {"rules_evaluated": 0, "rules_skipped": 0, "expressions_evaluated": 0, "expressions_reused": 0}
+    failed = None
+    for position in plan["order"]:
+        if failed is not None and position > failed[0]["position"]:
+            stats["rules_skipped"] += 1
+            continue
+        rule = plan["rules"][position]
+        mask, invalid_values = evaluate_plan_rule(df, plan, rule, cache, stats)
+        stats["rules_evaluated"] += 1
+        if mask.any():
+            failed = (rule, mask, invalid_values)
+    instrumentation.add_totals("rule_plan", stats)
+
+    if failed is not None:
+        rule, mask, invalid_values = failed
+        column = rule.get("column")
+        examples = df.loc[mask, [column]].head(10).to_string(index=True) if column in df.columns else ""
+        raise ValueError(rule["message"].format(
+            count=int(mask.sum()), column=column, values=invalid_values, examples=examples
+        ))
+
+# Collect-all mode: evaluate every rule on a data frame without stopping at the first failure.
+# Each violation is reported as a dict with the rule, the column, the number of violating rows and up to
+# sample_size sampled row indices (index labels of the data frame, which are global row numbers in streaming mode).
+# Numeric columns are checked as float64 values whatever they were read as (see reader_dtypes): missing and
+# fractional values are row-level violations, and text that is not a number (inferred reads, or the text fallback of
+# read_raw) is reported per row as non_numeric and checked as missing. Each row-level rule is decided on its own: it is skipped only when one of the
+# columns it reads is missing, and the schema violation is reported instead. Returns the data frame with Date
+# converted, and with the numeric columns back in their expected dtypes when no rule failed, and the violations.
+# When a row_masks dict is given, the violating-row mask of every failed row-level rule is stored in it under
+# (rule, column).
+def collect_violations(
+        df: pd.DataFrame,
+        tolerance: float,
+        typed: bool = True,
+        sample_size: int = REPORT_SAMPLE_ROWS,
+        row_masks: Optional[dict] = None,
+        exact_revenue: bool = False
+) -> tuple:
+    violations = []
+
+    def add(rule: str, column: Optional[str], mask: Optional[np.ndarray], count: Optional[int] = None, **details):
+        if mask is not None:
+            count = int(mask.sum())
+            if not count:
+                return
+            if row_masks is not None:
+                row_masks[(rule, column)] = mask
+            sample = df.index[mask][:sample_size].tolist()
+        else:
+            sample = []
+        violations.append({"rule": rule, "column": column, "violations": count, "sample_rows": sample, **details})
+
+    missing_columns = REQUIRED_COLUMNS - set(df.columns)
+    for col in sorted(missing_columns):
+        add("schema_missing_column", col, None, count=len(df))
+
+    if "Date" in df.columns:
+        dates = parse_dates_unique(df["Date"], DATE_FORMAT if typed else None)
+        add("date_invalid_or_missing", "Date", dates.isna().to_numpy())
+        df = df.assign(Date=dates)
+
+    numeric_columns = set(FUSED_RULE_COLUMNS.values())
+    for col, expected in EXPECTED_DTYPES.items():
+        if col in df.columns and col != "Date" and col not in numeric_columns:
+            actual = dtype_name(df[col].dtype)
+            if actual != expected and not (actual == "category" and expected == "object"):
+                add("dtype_mismatch", col, None, count=len(df), expected=expected, actual=actual)
+
+    for col in sorted(numeric_columns - missing_columns):
+        series = df[col]
+        if isinstance(series.dtype, np.dtype) and series.dtype.kind in "iuf":
+            continue
+        if pd.api.types.is_numeric_dtype(series):
+            # Arrow-backed or nullable numbers
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            values = pd.to_numeric(series.astype(object), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+            add("non_numeric", col, np.isnan(values) & series.notna().to_numpy())
+        df = df.assign(**{col: values})
+
+    for col, allowed_values in ALLOWED_VALUES.items():
+        if col in df.columns:
+            empty_as_na, invalid_mask, invalid_values = allowed_value_masks(df[col], allowed_values)
+            add("missing_or_blank", col, empty_as_na)
+            add("value_not_allowed", col, invalid_mask, invalid_values=invalid_values)
+
+    missing_numeric = numeric_columns & missing_columns
+    if missing_numeric != numeric_columns:
+        # Missing columns are stood in for by NaN so that the rules on the other columns still run
+        frame = df.assign(**{col: np.full(len(df), np.nan) for col in missing_numeric})
+        for rule, mask in compute_fused_violations(frame, tolerance, exact_revenue=exact_revenue).items():
+            if not ({FUSED_RULE_COLUMNS[rule]} | FUSED_RULE_INPUTS.get(rule, set())) & missing_numeric:
+                add(rule, FUSED_RULE_COLUMNS[rule], mask)
+
+    for col in sorted(REQUIRED_COLUMNS - missing_columns - numeric_columns - set(ALLOWED_VALUES) - {"Date"}):
+        add("missing_required", col, df[col].isna().to_numpy())
+
+    df = drop_temporary_columns(df)
+    if not violations:
+        df = restore_numeric_dtypes(df)
+    return df, sorted(violations, key=violation_order)
+
+# Cast the numeric columns back to their EXPECTED_DTYPES where that is lossless (integer columns are read, or
+# checked, as float64 in collect-all and quarantine mode). An integer column with missing values becomes a nullable
+# Int64 column and one with fractional values stays float64, so no value changes.
+def restore_numeric_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    casts = {}
+    for col in sorted(set(FUSED_RULE_COLUMNS.values()) & set(df.columns)):
+        expected = EXPECTED_DTYPES[col]
+        if dtype_name(df[col].dtype) == expected:
+            continue
+        if expected != "int64":
+            casts[col] = expected
+            continue
+        values = df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+        missing = np.isnan(values)
+        if np.any(values[~missing] % 1 != 0):
+            continue
+        casts[col] = "Int64" if missing.any() else "int64"
+    return df.astype(casts) if casts else df
+
+# Sort key of a violation: rules in the order of the pipeline steps, then by column
+def violation_order(violation: dict) -> tuple:
+    rules = [
+        "schema_missing_column",
+        "date_invalid_or_missing",
+        "dtype_mismatch",
+        "non_numeric",
+        "missing_or_blank",
+        "value_not_allowed",
+        *FUSED_RULES,
+        "missing_required",
+    ]
+    return rules.index(violation["rule"]), violation["column"] or ""
+
+# Merge the violations of one chunk into the running report of a streaming run, keyed by rule and column; the
+# sample_files of parallel runs are merged along with their sample_rows
+def merge_violations(report: dict, violations: list, sample_size: int = REPORT_SAMPLE_ROWS) -> None:
+    for violation in violations:
+        key = (violation["rule"], violation["column"])
+        if key not in report:
+            report[key] = dict(violation, sample_rows=list(violation["sample_rows"]))
+            continue
+        merged = report[key]
+        merged["violations"] += violation["violations"]
+        merged["sample_rows"] = (merged["sample_rows"] + violation["sample_rows"])[:sample_size]
+        if "sample_files" in violation:
+            merged["sample_files"] = (merged["sample_files"] + violation["sample_files"])[:sample_size]
+        if "invalid_values" in violation:
+            merged["invalid_values"] = sorted(set(merged["invalid_values"]) | set(violation["invalid_values"]))
+
+# Write a violation report as JSON to path, or to stdout when path is "-"
+def write_violation_report(path: str, rows_checked: int, violations: list) -> None:
+    report = {"rows_checked": rows_checked, "passed": not violations, "violations": violations}
+    text = json.dumps(report, indent=2, default=str)
+    if path == "-":
+        print(text)
+        return
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text(text + "\n")
+
+# One line per violation, for the error message of a failed collect-all run
+def summarize_violations(violations: list) -> str:
+    lines = [f"{len(violations)} rule(s) failed:"]
+    for v in violations:
+        rows = v["sample_rows"]
+        if "sample_files" in v:
+            rows = "[" + ", ".join(f"{file}:{row}" for file, row in zip(v["sample_files"], rows)) + "]"
+        lines.append(f"  {v['rule']} [{v['column']}]: {v['violations']} rows, e.g. rows {rows}")
+    return "\n".join(lines)
+
+# Quarantine mode: split a data frame into clean rows and rejected rows. Rows that fail only QUARANTINE_RULES are
+# rejected, with the failed rules joined in the Reject Reasons column; any other failure (schema, dtypes, dates,
+# Units Sold, missing required values) still fails the whole run. Returns the clean rows, the rejected rows and the
+# violations found.
+def quarantine_rows(df: pd.DataFrame, tolerance: float, typed: bool = True, exact_revenue: bool = False) -> tuple:
+    row_masks = {}
+    df, violations = collect_violations(
+        df, tolerance, typed=typed, row_masks=row_masks, exact_revenue=exact_revenue
+    )
+
+    fatal = [v for v in violations if v["rule"] not in QUARANTINE_RULES]
+    if fatal:
+        raise ValueError(summarize_violations(fatal))
+
+    rejected = np.zeros(len(df), dtype=bool)
+    for mask in row_masks.values():
+        rejected |= mask
+
+    rejects = df[rejected]
+    reasons = pd.Series("", index=rejects.index, dtype=object)
+    for (rule, column), mask in row_masks.items():
+        hit = mask[rejected]
+        reasons[hit] = reasons[hit] + f"{rule}[{column}];"
+    rejects = restore_numeric_dtypes(rejects).assign(**{REJECT_REASON_COLUMN: reasons.str.rstrip(";")})
+
+    return restore_numeric_dtypes(df[~rejected]), rejects, violations
+
+# Path of the rejects file of quarantine mode, next to the cleaned csv file and compressed like it
+def rejects_path(out_path: Path, compression: Optional[str] = None) -> Path:
+    return compressed_path(out_path.with_name(f"{out_path.stem}_rejects.csv"), compression)
+
+# Fail the run when the share of rejected rows exceeds max_reject_rate
+def check_reject_rate(rejected_rows: int, total_rows: int, max_reject_rate: float) -> None:
+    rate = rejected_rows / total_rows if total_rows else 0.0
+    if rate > max_reject_rate:
+        raise ValueError(
+            f"Quarantine failed: {rejected_rows} of {total_rows} rows rejected ({rate:.4%}), "
+            f"above the maximum reject rate of {max_reject_rate:.4%}."
+        )
+
+# Drop temporary columns created for revenue calculation and validation, if any are present in the data frame
+def drop_temporary_columns(df: pd.DataFrame) -> pd.DataFrame:
+    present = [col for col in TEMPORARY_COLUMNS if col in df.columns]
+    return df.drop(columns=present)
+
+# Validate that required columns have no missing values, raise an error with the count of missing values per column
+def validate_missing_required(df: pd.DataFrame, required_columns: set) -> None:
+    missing_counts = df[sorted(required_columns)].isna().sum()
+    missing_counts = missing_counts[missing_counts > 0]
+
+    if not missing_counts.empty:
+        raise ValueError(f"Missing values validation failed: {missing_counts.to_dict()}")
+
+# Write the cleaned data frame to csv, the file is overwritten with each successful run; with compression (a key of
+# COMPRESSION_SUFFIXES) the file is written through that codec
+def write_clean_csv(df: pd.DataFrame, out_path: Path, compression: Optional[str] = None) -> None:
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    if compression is None:
+        df.to_csv(out_path, index=False)
+        return
+    with open_csv_output(out_path, compression) as f:
+        df.to_csv(f, index=False)
+
+# Downcast a validated data frame to the compact schema: COMPACT_DTYPES for the numeric columns and categoricals over
+# allowed_values (int8 codes) for the string columns. Every column is verified to be lossless (integers round-trip
+# exactly, floats round-trip to COMPACT_DECIMALS decimal places, every string keeps its category); a column that does
+# not fit fails the run. The in-memory sizes before and after are added to the "compact" instrumentation totals.
+def compact_frame(df: pd.DataFrame, allowed_values: dict = ALLOWED_VALUES) -> pd.DataFrame:
+    bytes_before = int(df.memory_usage(deep=True, index=False).sum())
+    df = df.copy(deep=False)
+
+    for col, dtype in COMPACT_DTYPES.items():
+        if np.issubdtype(np.dtype(dtype), np.integer):
+            values = df[col].to_numpy(dtype=np.int64)
+            compact = values.astype(dtype)
+            lossless = np.array_equal(compact.astype(np.int64), values)
+        else:
+            values = df[col].to_numpy(dtype=np.float64)
+            compact = values.astype(dtype)
+            lossless = np.array_equal(
+                np.round(compact.astype(np.float64), COMPACT_DECIMALS), values, equal_nan=True
+            )
+        if not lossless:
+            raise ValueError(f"Compact schema failed: values of '{col}' cannot be stored losslessly as {dtype}.")
+        df[col] = compact
+
+    for col, values_of_col in allowed_values.items():
+        values = df[col].astype(object)
+        df[col] = pd.Categorical(values, categories=sorted(values_of_col))
+        if (df[col].isna() & values.notna()).any():
+            raise ValueError(f"Compact schema failed: values of '{col}' outside the allowed list.")
+
+    instrumentation.add_totals("compact", {
+        "bytes_before": bytes_before,
+        "bytes_after": int(df.memory_usage(deep=True, index=False).sum()),
+    })
+    return df
+
+# Path of the cleaned data file in the given output format, next to the cleaned csv file; a compressed csv file gets
+# the suffix of its codec
+def output_path(out_path: Path, output_format: str, compression: Optional[str] = None) -> Path:
+    if output_format == "csv":
+        return compressed_path(out_path, compression)
+    return out_path.with_suffix(f".{output_format}")
+
+# Convert a cleaned data frame to an arrow table for the columnar outputs. String columns are dictionary-encoded with
+# their list in allowed_values as the fixed dictionary, so every chunk of a streaming run shares one dictionary.
+def to_arrow_table(df: pd.DataFrame, allowed_values: dict = ALLOWED_VALUES):
+    import pyarrow as pa
+
+    df = df.copy()
+    for col, values_of_col in allowed_values.items():
+        values = df[col].astype(str)
+        df[col] = pd.Categorical(values, categories=sorted(values_of_col))
+        if df[col].isna().any():
+            unknown = sorted(set(values[df[col].isna()]))
+            raise ValueError(f"Columnar output failed for '{col}': values outside the allowed list {unknown}.")
+
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+# Open a columnar writer (parquet or Arrow IPC file) for tables with the given arrow schema.
+# Parquet keeps dictionary encoding for the string columns and writes row group statistics (min/max Date included);
+# the Arrow IPC file is uncompressed so it can be memory-mapped.
+def open_columnar_writer(output_format: str, path: Path, schema):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if output_format == "parquet":
+        return pq.ParquetWriter(
+            path,
+            schema,
+            use_dictionary=sorted(ALLOWED_VALUES),
+            write_statistics=True,
+        )
+    return pa.ipc.new_file(path, schema)
+
+# Write the cleaned data frame as a parquet or Arrow IPC (feather) file, overwritten with each successful run
+def write_clean_columnar(
+        df: pd.DataFrame,
+        out_path: Path,
+        output_format: str,
+        allowed_values: dict = ALLOWED_VALUES
+) -> None:
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    table = to_arrow_table(df, allowed_values)
+    with open_columnar_writer(output_format, out_path, table.schema) as writer:
+        writer.write_table(table, PARQUET_ROW_GROUP_ROWS if output_format == "parquet" else None)
+
+# Root directory of the partitioned output: a folder named after the cleaned csv file, next to it
+def partition_root(out_path: Path) -> Path:
+    return out_path.parent / out_path.stem
+
+# Load the manifest of the partitioned output, or an empty manifest if there is none yet
+def load_manifest(root: Path) -> dict:
+    manifest_path = root / MANIFEST_NAME
+    if not manifest_path.exists():
+        return {"partitions": {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+# Write the manifest atomically, so readers never see a half-written manifest
+def write_manifest(root: Path, manifest: dict) -> None:
+    manifest_path = root / MANIFEST_NAME
+    staging_path = manifest_path.with_name(manifest_path.name + ".staging")
+    with open(staging_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(staging_path, manifest_path)
+
+# Remove the files of every partition listed in a manifest, and the partition folders left empty
+def remove_partitions(root: Path, manifest: dict) -> None:
+    for relative, entry in manifest["partitions"].items():
+        for file_entry in entry["files"].values():
+            (root / file_entry["path"]).unlink(missing_ok=True)
+        folder = root / relative
+        while folder != root:
+            try:
+                folder.rmdir()
+            except OSError:
+                # Not empty: shared with another partition
+                break
+            folder = folder.parent
+
+# Write the cleaned data frame partitioned by ISO year / week of Date and, optionally, by the columns in partition_by
+# (Location, Platform), one folder per partition such as year=2020/week=02/Location=UK, holding one file per output
+# format. Each file is written to a staging file first and replaces the existing file only if its content hash
+# changed, so a rerun for one week rewrites only that week's partitions; partitions absent from df are kept.
+# When the existing output has a different layout (other partition_by columns), its partitions are removed first,
+# since they would overlap the new ones and a directory reader would count their rows twice.
+# The manifest lists every partition with its row count and the content hash of each file. Returns the manifest.
+def write_partitioned(
+        df: pd.DataFrame,
+        out_path: Path,
+        output_formats: tuple,
+        partition_by: tuple = (),
+        allowed_values: dict = ALLOWED_VALUES
+) -> dict:
+    unknown = set(partition_by) - set(PARTITION_COLUMNS)
+    if unknown:
+        raise ValueError(f"Partitioned output failed: cannot partition by {unknown}, expected any of {PARTITION_COLUMNS}.")
+
+    root = partition_root(out_path)
+    root.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(root)
+    layout = ["year", "week", *partition_by]
+    if manifest.get("partition_by", layout) != layout:
+        remove_partitions(root, manifest)
+        manifest = {"partitions": {}}
+        write_manifest(root, manifest)
+    manifest["partition_by"] = layout
+
+    iso = df["Date"].dt.isocalendar()
+    keys = [iso["year"].rename("year"), iso["week"].rename("week"), *(df[col] for col in partition_by)]
+
+    for key_values, part in df.groupby(keys, sort=True, observed=True):
+        key = dict(zip(manifest["partition_by"], key_values))
+        relative = Path(f"year={key['year']}", f"week={key['week']:02d}", *(f"{col}={key[col]}" for col in partition_by))
+        entry = {"keys": {name: str(value) for name, value in key.items()}, "rows": len(part), "files": {}}
+
+        for output_format in output_formats:
+            file_path = root / relative / f"part.{output_format}"
+            staging_path = file_path.with_name(file_path.name + ".staging")
+            if output_format == "csv":
+                write_clean_csv(part, staging_path)
+            else:
+                write_clean_columnar(part, staging_path, output_format, allowed_values)
+
+            digest = file_sha256(staging_path)
+            if file_path.exists() and file_sha256(file_path) == digest:
+                staging_path.unlink()
+            else:
+                os.replace(staging_path, file_path)
+            entry["files"][output_format] = {"path": str(relative / file_path.name), "sha256": digest}
+
+        manifest["partitions"][str(relative)] = entry
+
+    write_manifest(root, manifest)
+    return manifest
+
+# Compression codec of a file from its suffix (see COMPRESSION_SUFFIXES), None for an uncompressed file
+def compression_codec(path: Path) -> Optional[str]:
+    for codec, suffix in COMPRESSION_SUFFIXES.items():
+        if path.suffix == suffix:
+            return codec
+    return None
+
+# Path of a file compressed with the given codec: the codec's suffix appended to the name
+def compressed_path(path: Path, compression: Optional[str]) -> Path:
+    if compression is None:
+        return path
+    return path.with_name(path.name + COMPRESSION_SUFFIXES[compression])
+
+# Open a file in binary mode ("rb" or "wb") through a compression codec, or uncompressed when compression is None
+def open_compressed(path: Path, mode: str, compression: Optional[str]):
+    if compression is None:
+        return open(path, mode)
+    if compression == "gzip":
+        return gzip.open(path, mode, compresslevel=COMPRESSION_LEVELS["gzip"])
+    if compression == "bz2":
+        return bz2.open(path, mode, compresslevel=COMPRESSION_LEVELS["bz2"])
+    if compression == "zstd":
+        import zstandard
+
+        if "w" in mode:
+            return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=COMPRESSION_LEVELS["zstd"]))
+        return zstandard.open(path, mode)
+    raise ValueError(f"Compression failed: unknown codec '{compression}', expected one of {tuple(COMPRESSION_SUFFIXES)}.")
+
+# Open a csv output file for writing text, compressed with the given codec
+def open_csv_output(path: Path, compression: Optional[str]):
+    return io.TextIOWrapper(open_compressed(path, "wb", compression), encoding="utf-8", newline="")
+
+# Read a compressed raw file as a stream of decompressed bytes. A background thread decompresses the file
+# DECOMPRESS_BLOCK_BYTES at a time into a pipe and the caller reads the other end, so decompression overlaps with
+# parsing (zlib, bz2 and zstd release the GIL while they work). Closing the stream early stops the thread; an error
+# of the thread (corrupt or truncated file) is raised when the stream is closed, in place of any parse error it caused.
+@contextmanager
+def decompressed_stream(raw_path: Path) -> Iterator:
+    codec = compression_codec(raw_path)
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def decompress() -> None:
+        try:
+            with open(write_fd, "wb") as sink, open_compressed(raw_path, "rb", codec) as source:
+                for block in iter(lambda: source.read(DECOMPRESS_BLOCK_BYTES), b""):
+                    sink.write(block)
+        except BrokenPipeError:
+            # The reader stopped early
+            pass
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=decompress, name=f"decompress-{raw_path.name}", daemon=True)
+    thread.start()
+    stream = open(read_fd, "rb")
+    try:
+        yield stream
+    finally:
+        stream.close()
+        thread.join()
+        if errors:
+            raise ValueError(f"Reading failed: cannot decompress {raw_path} ({codec}): {errors[0]}") from errors[0]
+
+# Open the raw data file as a binary stream, decompressed in a background thread when it is compressed
+def open_raw(raw_path: Path):
+    if compression_codec(raw_path) is not None:
+        return decompressed_stream(raw_path)
+    return open(raw_path, "rb")
+
+# Dtype map passed to the csv reader: the EXPECTED_DTYPES of all columns except Date, with string columns read as
+# categoricals. Date is read as text and parsed by convert_date with the fixed DATE_FORMAT.
+# With tolerant=True (collect-all and quarantine mode) integer columns are read as float64, so that missing and
+# fractional values reach the row-level rules instead of failing the read. With numeric_as_text=True the numeric
+# columns are read as text (the fallback of read_raw when a tolerant read meets text in a numeric column).
+def reader_dtypes(tolerant: bool = False, numeric_as_text: bool = False) -> dict:
+    dtypes = {}
+    for col, expected in EXPECTED_DTYPES.items():
+        if col == "Date":
+            dtypes[col] = "object"
+        elif expected == "object":
+            dtypes[col] = "category"
+        elif numeric_as_text:
+            dtypes[col] = "object"
+        elif expected == "int64" and tolerant:
+            dtypes[col] = "float64"
+        else:
+            dtypes[col] = expected
+    return dtypes
+
+# Read the raw data file with the multithreaded pyarrow csv reader. Typed reads pass the arrow equivalent of
+# reader_dtypes to the parser itself (string columns dictionary-encoded). Numeric and text columns stay arrow-backed
+# in the data frame, dictionary columns become pandas categoricals.
+def read_raw_arrow(
+        raw_path: Path,
+        typed: bool = True,
+        tolerant: bool = False,
+        numeric_as_text: bool = False
+) -> pd.DataFrame:
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+
+    # Numeric columns read as text keep blank values missing, as they are in the numeric read
+    convert_options = pa_csv.ConvertOptions(strings_can_be_null=numeric_as_text)
+    if typed:
+        arrow_types = {
+            "object": pa.string(),
+            "category": pa.dictionary(pa.int32(), pa.string()),
+            "int64": pa.int64(),
+            "float64": pa.float64(),
+        }
+        convert_options.column_types = {
+            col: arrow_types[dtype] for col, dtype in reader_dtypes(tolerant, numeric_as_text).items()
+        }
+
+    table = pa_csv.read_csv(
+        raw_path,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        convert_options=convert_options,
+    )
+    return table.to_pandas(types_mapper=lambda t: None if pa.types.is_dictionary(t) else pd.ArrowDtype(t))
+
+# Open the raw data file. With typed=True the reader gets the explicit dtype map and fails fast on type mismatches
+# (for example a decimal or missing value in an integer column); with typed=False pandas infers every column.
+# engine is one of READER_ENGINES: "c" (pandas C parser), "pyarrow" (multithreaded arrow csv reader producing
+# arrow-backed columns) or "python" (pure-Python fallback parser).
+# With chunksize the data frames are yielded one chunk at a time, otherwise the whole file is yielded at once.
+# tolerant selects the tolerant dtype map of reader_dtypes for typed reads. When a tolerant typed read fails (text in
+# a numeric column), the rest of the file is read again with the numeric columns as text, so that collect_violations
+# reports the text per row as non_numeric; a file that does not parse as text either fails with the typed read error.
+# In streaming mode only the chunks that were not yielded yet are read again, numbered on from the last one.
+# A compressed raw file (see COMPRESSION_SUFFIXES) is parsed from the stream of decompressed_stream; a whole file is
+# read completely, and any decompression error raised, before it is yielded.
+def read_raw(
+        raw_path: Path,
+        typed: bool = True,
+        chunksize: Optional[int] = None,
+        engine: str = "c",
+        tolerant: bool = False
+) -> Iterator[pd.DataFrame]:
+    if engine not in READER_ENGINES:
+        raise ValueError(f"Reading failed: unknown reader engine '{engine}', expected one of {READER_ENGINES}.")
+
+    if engine == "pyarrow" and chunksize is not None:
+        raise ValueError("Reading failed: the pyarrow reader engine does not support streaming mode (--chunk-size).")
+
+    frames = []
+    rows_read = 0
+    with ExitStack() as stack:
+
+        # Parse the raw file from its start, skipping the first skip_rows data rows
+        def parse(numeric_as_text: bool = False, skip_rows: int = 0) -> Iterator[pd.DataFrame]:
+            source = raw_path
+            if isinstance(raw_path, Path) and compression_codec(raw_path) is not None:
+                source = stack.enter_context(decompressed_stream(raw_path))
+            elif hasattr(raw_path, "seek"):
+                raw_path.seek(0)
+            dtype = reader_dtypes(tolerant, numeric_as_text) if typed else None
+            if engine == "pyarrow":
+                yield read_raw_arrow(source, typed=typed, tolerant=tolerant, numeric_as_text=numeric_as_text)
+            elif chunksize is None:
+                yield pd.read_csv(source, dtype=dtype, engine=engine)
+            else:
+                skiprows = range(1, skip_rows + 1) if skip_rows else None
+                with pd.read_csv(source, dtype=dtype, engine=engine, chunksize=chunksize, skiprows=skiprows) as reader:
+                    for chunk in reader:
+                        chunk.index = pd.RangeIndex(skip_rows + chunk.index.start, skip_rows + chunk.index.stop)
+                        yield chunk
+
+        # Whole files are kept until the decompressed stream is closed, chunks are yielded as they are read
+        def read(numeric_as_text: bool = False) -> Iterator[pd.DataFrame]:
+            nonlocal rows_read
+            for df in parse(numeric_as_text, rows_read):
+                rows_read += len(df)
+                if chunksize is None:
+                    frames.append(df)
+                else:
+                    yield df
+
+        try:
+            yield from read()
+        except (ValueError, TypeError) as e:
+            if not (typed and tolerant):
+                raise ValueError(f"Typed read failed: {e}") from e
+            try:
+                yield from read(numeric_as_text=True)
+            except (ValueError, TypeError):
+                raise ValueError(f"Typed read failed: {e}") from e
+    yield from frames
+
+# Parsed cache (--parsed-cache): a sidecar directory next to the raw file with one .npy file per column of the typed
+# read (numeric columns as they are, text columns as integer codes plus their categories) and a manifest.json with the
+# size, mtime and digest of the raw file it was parsed from. Later runs memory-map the .npy files instead of parsing
+# the csv file; only the pages a step touches are read from disk.
+def parsed_cache_dir(raw_path: Path) -> Path:
+    return raw_path.with_name(raw_path.name + ".parsed-cache")
+
+# Write the parsed cache of a typed data frame, atomically: the directory is built under a staging name and renamed
+# into place. raw_state is the file_state of the raw file taken before it was parsed.
+def save_parsed_cache(raw_path: Path, df: pd.DataFrame, raw_state: dict) -> None:
+    cache_dir = parsed_cache_dir(raw_path)
+    staging_dir = cache_dir.with_name(cache_dir.name + ".staging")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    staging_dir.mkdir()
+
+    columns = []
+    for position, col in enumerate(df.columns):
+        series = df[col]
+        entry = {"name": col, "file": f"column_{position:02d}.npy"}
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            values = series.cat.codes.to_numpy()
+            entry["categories"] = series.cat.categories.tolist()
+        elif pd.api.types.is_integer_dtype(series.dtype) and not series.hasnans:
+            values = series.to_numpy(dtype=np.int64)
+        elif pd.api.types.is_numeric_dtype(series.dtype):
+            values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            codes, uniques = pd.factorize(series)
+            values = codes.astype(np.int8 if len(uniques) < 128 else np.int32)
+            entry["categories"] = [str(value) for value in uniques]
+        np.save(staging_dir / entry["file"], values)
+        columns.append(entry)
+
+    manifest = {
+        "version": PARSED_CACHE_VERSION,
+        "raw": raw_state,
+        "dtypes": reader_dtypes(),
+        "rows": len(df),
+        "columns": columns,
+    }
+    (staging_dir / "manifest.json").write_text(json.dumps(manifest, indent=2) + "\n")
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(staging_dir, cache_dir)
+
+# Memory-map the parsed cache of a raw file as a data frame; None when there is no cache, or it was written for another
+# version of the raw file, of the cache layout or of the reader dtypes. The raw file is checked as in the run manifest:
+# one stat when size and mtime are unchanged, the digest only when the mtime changed.
+def load_parsed_cache(raw_path: Path) -> Optional[pd.DataFrame]:
+    cache_dir = parsed_cache_dir(raw_path)
+    try:
+        manifest = json.loads((cache_dir / "manifest.json").read_text())
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != PARSED_CACHE_VERSION or manifest.get("dtypes") != reader_dtypes():
+        return None
+    if not file_unchanged(dict(manifest["raw"], path=str(raw_path))):
+        return None
+
+    # Same content under a new mtime (file touched or copied): record the new mtime, so the next run needs no digest
+    mtime_ns = raw_path.stat().st_mtime_ns
+    if mtime_ns != manifest["raw"]["mtime_ns"]:
+        manifest["raw"]["mtime_ns"] = mtime_ns
+        staging_path = cache_dir / "manifest.json.staging"
+        try:
+            staging_path.write_text(json.dumps(manifest, indent=2) + "\n")
+            os.replace(staging_path, cache_dir / "manifest.json")
+        except OSError:
+            pass
+
+    data = {}
+    for entry in manifest["columns"]:
+        values = np.load(cache_dir / entry["file"], mmap_mode="r")
+        if "categories" in entry:
+            data[entry["name"]] = pd.Categorical.from_codes(values, categories=entry["categories"])
+        else:
+            data[entry["name"]] = values
+    return pd.DataFrame(data, copy=False)
+
+# Read the raw file through its parsed cache: memory-map the cache when it is current, otherwise parse the csv file
+# with the typed reader, write the cache and memory-map it. The data frame is the same either way (text columns,
+# Date included, as categoricals). Also usable from the notebook.
+def read_raw_cached(raw_path: Path, engine: str = "c") -> pd.DataFrame:
+    df = load_parsed_cache(raw_path)
+    if df is not None:
+        return df
+
+    raw_state = file_state(raw_path)
+    df = next(read_raw(raw_path, typed=True, engine=engine))
+    try:
+        save_parsed_cache(raw_path, df, raw_state)
+    except OSError as e:
+        print(f"Parsed cache not written: {e}", file=sys.stderr)
+        return df
+    return load_parsed_cache(raw_path)
+
+# Fingerprint of the rule set: every constant the validate_* functions depend on plus RULESET_VERSION.
+# Changing any allowed value list, the tolerance, the schema or the date format changes the fingerprint.
+def ruleset_fingerprint(exact_revenue: bool = False, rule_plan: Optional[dict] = None) -> str:
+    rules = {
+        "version": RULESET_VERSION,
+        "required_columns": sorted(REQUIRED_COLUMNS),
+        "allowed_values": {col: sorted(values) for col, values in ALLOWED_VALUES.items()},
+        "tolerance": TOLERANCE,
+        "expected_dtypes": EXPECTED_DTYPES,
+        "date_format": DATE_FORMAT,
+        "exact_revenue": exact_revenue,
+        "rule_spec": rule_plan["digest"] if rule_plan is not None else None,
+    }
+    return hashlib.sha256(json.dumps(rules, sort_keys=True).encode()).hexdigest()
+
+# Path of the validation cache of a raw data file, stored next to it
+def validation_cache_path(raw_path: Path) -> Path:
+    return raw_path.with_name(raw_path.name + ".validation-cache.json")
+
+# Load the digests of the blocks that passed validation under the current rule set; a cache written under another
+# rule set fingerprint (see ruleset_fingerprint) is ignored
+def load_validation_cache(cache_path: Path, ruleset: str) -> set:
+    if not cache_path.exists():
+        return set()
+    with open(cache_path) as f:
+        cache = json.load(f)
+    if cache.get("ruleset") != ruleset:
+        return set()
+    return set(cache.get("passed_blocks", []))
+
+# Atomically save the digests of the blocks that passed validation together with the rule set fingerprint
+def save_validation_cache(cache_path: Path, passed_blocks: set, ruleset: str) -> None:
+    staging_path = cache_path.with_name(cache_path.name + ".staging")
+    with open(staging_path, "w") as f:
+        json.dump({"ruleset": ruleset, "passed_blocks": sorted(passed_blocks)}, f, indent=2)
+    os.replace(staging_path, cache_path)
+
+# Split the raw file into blocks of about block_bytes, each extended to the end of its last line, and yield every
+# block parsed as a data frame together with the SHA-256 digest of the header line and the block's bytes.
+# Appending rows to the raw file changes only the digest of the last block.
+def iter_raw_blocks(
+        raw_path: Path,
+        typed: bool = True,
+        engine: str = "c",
+        block_bytes: int = CACHE_BLOCK_BYTES,
+        tolerant: bool = False
+) -> Iterator[tuple]:
+    first_row = 0
+    with open_raw(raw_path) as f:
+        header = f.readline()
+        while True:
+            block = f.read(block_bytes)
+            if not block:
+                break
+            block += f.readline()
+
+            digest = hashlib.sha256(header + block).hexdigest()
+            df = next(read_raw(io.BytesIO(header + block), typed=typed, engine=engine, tolerant=tolerant))
+            # Number rows from the start of the file, like the chunks of the streaming reader
+            df.index = pd.RangeIndex(first_row, first_row + len(df))
+            first_row += len(df)
+            yield df, digest
+
+# Rule groups of steps 5-16 as tasks for the thread-pool scheduler, in pipeline order: name -> (names of the tasks
+# that must pass first, function). The allowed value checks and the per-column numeric checks are independent;
+# Units Returned is compared with Units Sold, and Revenue is computed from Units Sold, Price and Discount.
+def rule_tasks(
+        df: pd.DataFrame,
+        fused: bool = False,
+        exact_revenue: bool = False,
+        infer_revenue: bool = False
+) -> dict:
+    check_revenue = revenue_validator(exact_revenue, infer_revenue)
+    tasks = {
+        "05_product_name": ((), lambda: validate_allowed_values(df, "Product Name", ALLOWED_PRODUCT_NAMES)),
+        "06_category": ((), lambda: validate_allowed_values(df, "Category", ALLOWED_CATEGORIES)),
+    }
+    if fused:
+        tasks["07-14_numeric_fused"] = ((), lambda: validate_numeric_fused(df, TOLERANCE, exact_revenue=exact_revenue))
+    else:
+        tasks["07_units_sold"] = ((), lambda: validate_sold_units(df))
+        tasks["08_units_returned"] = (("07_units_sold",), lambda: validate_units_returned(df))
+        tasks["09_price"] = ((), lambda: validate_price(df))
+        tasks["10_discount"] = ((), lambda: validate_discount(df))
+        tasks["11-14_revenue"] = (
+            ("07_units_sold", "09_price", "10_discount"), lambda: check_revenue(df, TOLERANCE)
+        )
+    tasks["15_location"] = ((), lambda: validate_allowed_values(df, "Location", ALLOWED_LOCATIONS))
+    tasks["16_platform"] = ((), lambda: validate_allowed_values(df, "Platform", ALLOWED_PLATFORMS))
+    return tasks
+
+# Run one rule task, returning its duration and the validation error it raised, if any
+def run_timed(func) -> tuple:
+    start = time.perf_counter()
+    try:
+        func()
+    except ValueError as e:
+        return time.perf_counter() - start, e
+    return time.perf_counter() - start, None
+
+# Run rule tasks on a thread pool: every task is submitted as soon as all its dependencies have passed, so independent
+# column checks (NumPy and pandas kernels that release the GIL) overlap. Tasks depending on a failed task are skipped.
+# If any task fails, the error of the first failing task in pipeline order is raised, as in the sequential path.
+# Returns the serial time (sum of task times), the critical path time (longest dependency chain) and the wall time.
+def run_rule_schedule(tasks: dict, threads: int) -> dict:
+    durations = {}
+    errors = {}
+    passed = set()
+    failed = set()
+    pending = dict(tasks)
+    running = {}
+    wall_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        def submit_ready() -> None:
+            for name, (dependencies, func) in list(pending.items()):
+                if any(dep in failed for dep in dependencies):
+                    del pending[name]
+                    failed.add(name)
+                elif all(dep in passed for dep in dependencies):
+                    del pending[name]
+                    running[pool.submit(run_timed, func)] = name
+
+        submit_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                durations[name], error = future.result()
+                if error is None:
+                    passed.add(name)
+                else:
+                    errors[name] = error
+                    failed.add(name)
+            submit_ready()
+
+    if errors:
+        raise errors[next(name for name in tasks if name in errors)]
+
+    # Tasks are in pipeline order, so every dependency's path length is known before the task that needs it
+    path_seconds = {}
+    for name, (dependencies, _) in tasks.items():
+        path_seconds[name] = durations[name] + max((path_seconds[dep] for dep in dependencies), default=0.0)
+
+    return {
+        "runs": 1,
+        "serial_seconds": sum(durations.values()),
+        "critical_path_seconds": max(path_seconds.values(), default=0.0),
+        "wall_seconds": time.perf_counter() - wall_start,
+    }
+
+# Revenue check of steps 11-14 for the selected mode
+def revenue_validator(exact_revenue: bool = False, infer_revenue: bool = False):
+    if exact_revenue:
+        return validate_revenue_exact
+    if infer_revenue:
+        return validate_revenue_inferred
+    return validate_revenue
+
+# Run validation steps 2-18 on one data frame (the whole file or a single chunk) and return the cleaned data frame.
+# With threads, steps 5-16 run on the thread-pool rule scheduler instead of one after another. With exact_revenue
+# steps 11-14 compare revenues in integer cents (revenue_mismatch_cents); with infer_revenue they check the dominant
+# formula first (validate_revenue_inferred). With rule_plan, steps 5-16 are the compiled rules of a rule spec file.
+def validate_frame(
+        df: pd.DataFrame,
+        fused: bool = False,
+        typed: bool = True,
+        threads: Optional[int] = None,
+        exact_revenue: bool = False,
+        infer_revenue: bool = False,
+        rule_plan: Optional[dict] = None
+) -> pd.DataFrame:
+    with stage("02_schema"):
+        validate_schema(df, REQUIRED_COLUMNS)
+    with stage("03_convert_date"):
+        df = convert_date(df, DATE_FORMAT if typed else None)
+    with stage("04_dtypes"):
+        validate_dtypes(df)
+
+    if rule_plan is not None:
+        with stage("05-16_rule_plan"):
+            validate_with_plan(df, rule_plan)
+        with stage("17_drop_temporary_columns"):
+            df = drop_temporary_columns(df)
+        with stage("18_missing_required"):
+            validate_missing_required(df, REQUIRED_COLUMNS)
+        return df
+
+    if threads is not None:
+        with stage("05-16_rule_schedule"):
+            tasks = rule_tasks(df, fused=fused, exact_revenue=exact_revenue, infer_revenue=infer_revenue)
+            schedule = run_rule_schedule(tasks, threads)
+        instrumentation.add_totals("rule_schedule", schedule)
+        with stage("17_drop_temporary_columns"):
+            df = drop_temporary_columns(df)
+        with stage("18_missing_required"):
+            validate_missing_required(df, REQUIRED_COLUMNS)
+        return df
+
+    with stage("05_product_name"):
+        validate_allowed_values(df, "Product Name", ALLOWED_PRODUCT_NAMES)
+    with stage("06_category"):
+        validate_allowed_values(df, "Category", ALLOWED_CATEGORIES)
+    if fused:
+        with stage("07-14_numeric_fused"):
+            validate_numeric_fused(df, TOLERANCE, exact_revenue=exact_revenue)
+    else:
+        with stage("07_units_sold"):
+            validate_sold_units(df)
+        with stage("08_units_returned"):
+            validate_units_returned(df)
+        with stage("09_price"):
+            validate_price(df)
+        with stage("10_discount"):
+            validate_discount(df)
+        with stage("11-14_revenue"):
+            revenue_validator(exact_revenue, infer_revenue)(df, TOLERANCE)
+    with stage("15_location"):
+        validate_allowed_values(df, "Location", ALLOWED_LOCATIONS)
+    with stage("16_platform"):
+        validate_allowed_values(df, "Platform", ALLOWED_PLATFORMS)
+    with stage("17_drop_temporary_columns"):
+        df = drop_temporary_columns(df)
+    with stage("18_missing_required"):
+        validate_missing_required(df, REQUIRED_COLUMNS)
+    return df
+
+# Load the whole raw file into memory, validate it and write the cleaned csv file. Returns the number of rows written.
+def run_full(
+        raw_path: Path,
+        out_path: Path,
+        fused: bool = False,
+        typed: bool = True,
+        engine: str = "c",
+        output_formats: tuple = ("csv",),
+        partition_by: Optional[tuple] = None,
+        collect_all: bool = False,
+        report_path: Optional[str] = None,
+        max_reject_rate: Optional[float] = None,
+        threads: Optional[int] = None,
+        exact_revenue: bool = False,
+        infer_revenue: bool = False,
+        compact: bool = False,
+        rule_plan: Optional[dict] = None,
+        parsed_cache: bool = False,
+        compression: Optional[str] = None
+) -> int:
+    with stage("01_read"):
+        if parsed_cache:
+            df = read_raw_cached(raw_path, engine=engine)
+        else:
+            tolerant = collect_all or max_reject_rate is not None
+            df = next(read_raw(raw_path, typed=typed, engine=engine, tolerant=tolerant))
+
+    if max_reject_rate is not None:
+        total_rows = len(df)
+        with stage("02-18_quarantine"):
+            df, rejects, violations = quarantine_rows(df, TOLERANCE, typed=typed, exact_revenue=exact_revenue)
+        if report_path is not None:
+            write_violation_report(report_path, total_rows, violations)
+        check_reject_rate(len(rejects), total_rows, max_reject_rate)
+        write_clean_csv(rejects, rejects_path(out_path, compression), compression)
+    elif collect_all:
+        with stage("02-18_collect_all"):
+            df, violations = collect_violations(df, TOLERANCE, typed=typed, exact_revenue=exact_revenue)
+        if report_path is not None:
+            write_violation_report(report_path, len(df), violations)
+        if violations:
+            raise ValueError(summarize_violations(violations))
+    else:
+        df = validate_frame(
+            df,
+            fused=fused,
+            typed=typed,
+            threads=threads,
+            exact_revenue=exact_revenue,
+            infer_revenue=infer_revenue,
+            rule_plan=rule_plan,
+        )
+
+    allowed_values = plan_allowed_values(rule_plan)
+    df = normalize_allowed_columns(df, allowed_values)
+    if compact:
+        with stage("19_compact"):
+            df = compact_frame(df, allowed_values)
+
+    with stage("19_write"):
+        if partition_by is not None:
+            write_partitioned(df, out_path, output_formats, partition_by, allowed_values)
+            return len(df)
+
+        for output_format in output_formats:
+            if output_format == "csv":
+                write_clean_csv(df, output_path(out_path, "csv", compression), compression)
+            else:
+                write_clean_columnar(df, output_path(out_path, output_format), output_format, allowed_values)
+    return len(df)
+
+# Overlapped streaming: run the three stages read -> process -> write of a streaming run in their own threads (the
+# processing stage in the calling thread), connected by bounded queues of queue_size chunks. Reading the next chunk,
+# validating the current one and writing the previous one overlap; a full queue blocks the stage before it
+# (backpressure), so at most about 2 * queue_size + 3 chunks are in memory. The first error of any stage stops all
+# stages and is raised (errors of the writer, which is furthest behind in the file, take precedence, then those of
+# the processing stage, then those of the reader). Returns the busy time, waiting time and utilization of each stage.
+def run_overlapped(items: Iterable, process: Callable, write: Callable, queue_size: int) -> dict:
+    done = object()
+    stop = threading.Event()
+    read_queue = queue.Queue(maxsize=queue_size)
+    write_queue = queue.Queue(maxsize=queue_size)
+    errors = {}
+    timings = {name: {"busy_seconds": 0.0, "wait_seconds": 0.0} for name in ("read", "process", "write")}
+
+    def put(name: str, target: queue.Queue, item) -> None:
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        timings[name]["wait_seconds"] += time.perf_counter() - start
+
+    def get(name: str, source: queue.Queue):
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    return source.get(timeout=0.1)
+                except queue.Empty:
+                    if stop.is_set():
+                        return done
+        finally:
+            timings[name]["wait_seconds"] += time.perf_counter() - start
+
+    def reader() -> None:
+        iterator = iter(items)
+        try:
+            while not stop.is_set():
+                start = time.perf_counter()
+                item = next(iterator, done)
+                timings["read"]["busy_seconds"] += time.perf_counter() - start
+                put("read", read_queue, item)
+                if item is done:
+                    return
+        except BaseException as e:
+            errors["read"] = e
+            stop.set()
+
+    def writer() -> None:
+        try:
+            while True:
+                item = get("write", write_queue)
+                if item is done:
+                    return
+                start = time.perf_counter()
+                write(item)
+                timings["write"]["busy_seconds"] += time.perf_counter() - start
+        except BaseException as e:
+            errors["write"] = e
+            stop.set()
+
+    wall_start = time.perf_counter()
+    threads = [threading.Thread(target=reader, daemon=True), threading.Thread(target=writer, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = get("process", read_queue)
+            if item is done:
+                break
+            start = time.perf_counter()
+            result = process(item)
+            timings["process"]["busy_seconds"] += time.perf_counter() - start
+            put("process", write_queue, result)
+    except BaseException as e:
+        errors["process"] = e
+        stop.set()
+    finally:
+        put("process", write_queue, done)
+        for thread in threads:
+            thread.join()
+
+    for name in ("write", "process", "read"):
+        if name in errors:
+            raise errors[name]
+
+    wall = time.perf_counter() - wall_start
+    for stats in timings.values():
+        stats["utilization"] = stats["busy_seconds"] / wall if wall else 0.0
+    timings["wall_seconds"] = wall
+    return timings
+
+# Streaming mode: read the raw file in chunks of chunk_size rows, validate each chunk and append it to a staging file
+# next to each selected output. Peak memory is bounded by the chunk size. The staging files replace the outputs only
+# after every chunk has passed; on any failure the staging files are removed and the previous outputs are left
+# untouched. Each chunk becomes its own parquet row group / IPC record batch.
+# With cache_path the chunks are the newline-aligned blocks of iter_raw_blocks instead, and blocks whose digest is
+# recorded in the validation cache are only converted, not re-validated; the cache is updated with every block that
+# passes, even when a later block fails.
+# With overlap_queue the read, process and write stages overlap through run_overlapped with queues of that size.
+# With source_column (multi-file input of a single file) the rows are tagged with the raw file, see tag_source_file.
+def run_streaming(
+        raw_path: Path,
+        out_path: Path,
+        chunk_size: Optional[int],
+        fused: bool = False,
+        typed: bool = True,
+        engine: str = "c",
+        output_formats: tuple = ("csv",),
+        cache_path: Optional[Path] = None,
+        collect_all: bool = False,
+        report_path: Optional[str] = None,
+        max_reject_rate: Optional[float] = None,
+        threads: Optional[int] = None,
+        overlap_queue: Optional[int] = None,
+        exact_revenue: bool = False,
+        infer_revenue: bool = False,
+        compact: bool = False,
+        rule_plan: Optional[dict] = None,
+        source_column: bool = False,
+        compression: Optional[str] = None
+) -> int:
+    if cache_path is None and (chunk_size is None or chunk_size <= 0):
+        raise ValueError(f"Streaming mode failed: chunk size must be positive, got {chunk_size}.")
+    if overlap_queue is not None and overlap_queue <= 0:
+        raise ValueError(f"Streaming mode failed: queue size must be positive, got {overlap_queue}.")
+
+    tolerant = collect_all or max_reject_rate is not None
+    if cache_path is not None:
+        ruleset = ruleset_fingerprint(exact_revenue, rule_plan)
+        cached_blocks = load_validation_cache(cache_path, ruleset)
+        chunks = iter_raw_blocks(raw_path, typed=typed, engine=engine, tolerant=tolerant)
+    else:
+        cached_blocks = set()
+        chunks = (
+            (chunk, None)
+            for chunk in read_raw(raw_path, typed=typed, chunksize=chunk_size, engine=engine, tolerant=tolerant)
+        )
+    passed_blocks = set()
+    report = {}
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    final_paths = {fmt: output_path(out_path, fmt, compression) for fmt in output_formats}
+    if max_reject_rate is not None:
+        final_paths["rejects"] = rejects_path(out_path, compression)
+    staging_paths = {fmt: path.with_name(path.name + ".staging") for fmt, path in final_paths.items()}
+    columnar_formats = [fmt for fmt in output_formats if fmt != "csv"]
+    allowed_values = plan_allowed_values(rule_plan)
+    counts = {"read": 0, "written": 0, "rejected": 0}
+
+    try:
+        with ExitStack() as stack:
+            writers = {}
+            headers_written = set()
+            schema = None
+            for fmt in ("csv", "rejects"):
+                if fmt in staging_paths:
+                    writers[fmt] = stack.enter_context(open_csv_output(staging_paths[fmt], compression))
+
+            # Process stage: validate one chunk; returns the chunk to write and its rejected rows, if any
+            def process_chunk(item: tuple) -> tuple:
+                chunk_number, (chunk, digest) = item
+                first_row = counts["read"]
+                counts["read"] += len(chunk)
+                rejects = None
+                violations = []
+                try:
+                    if digest in cached_blocks:
+                        # Block passed under the current rule set before: only convert it for the output
+                        validate_schema(chunk, REQUIRED_COLUMNS)
+                        chunk = drop_temporary_columns(convert_date(chunk, DATE_FORMAT if typed else None))
+                        if tolerant:
+                            chunk = restore_numeric_dtypes(chunk)
+                    elif max_reject_rate is not None:
+                        with stage("02-18_quarantine"):
+                            chunk, rejects, violations = quarantine_rows(
+                                chunk, TOLERANCE, typed=typed, exact_revenue=exact_revenue
+                            )
+                        merge_violations(report, violations)
+                    elif collect_all:
+                        with stage("02-18_collect_all"):
+                            chunk, violations = collect_violations(
+                                chunk, TOLERANCE, typed=typed, exact_revenue=exact_revenue
+                            )
+                        merge_violations(report, violations)
+                        if violations:
+                            # The run fails after the last chunk; nothing of a failing chunk is written
+                            return None, None
+                    else:
+                        chunk = validate_frame(
+                            chunk,
+                            fused=fused,
+                            typed=typed,
+                            threads=threads,
+                            exact_revenue=exact_revenue,
+                            infer_revenue=infer_revenue,
+                            rule_plan=rule_plan,
+                        )
+                except ValueError as e:
+                    raise ValueError(
+                        f"Chunk {chunk_number} (rows {first_row}-{counts['read'] - 1}): {e}"
+                    ) from e
+
+                if digest is not None and not violations:
+                    passed_blocks.add(digest)
+                chunk = normalize_allowed_columns(chunk, allowed_values)
+                if compact:
+                    with stage("19_compact"):
+                        chunk = compact_frame(chunk, allowed_values)
+                if source_column:
+                    chunk = tag_source_file(chunk, raw_path)
+                    if rejects is not None:
+                        rejects = tag_source_file(rejects, raw_path, (REJECT_REASON_COLUMN,))
+                return chunk, rejects
+
+            # Write stage: append one processed chunk to the staging files
+            def write_chunk(item: tuple) -> None:
+                nonlocal schema
+                chunk, rejects = item
+                if chunk is None:
+                    return
+                with stage("19_write"):
+                    # Compressed writers cannot tell their position, so the header is tracked per file
+                    for fmt, frame in (("rejects", rejects), ("csv", chunk)):
+                        if frame is not None and fmt in writers:
+                            frame.to_csv(writers[fmt], header=fmt not in headers_written, index=False)
+                            headers_written.add(fmt)
+                    if rejects is not None:
+                        counts["rejected"] += len(rejects)
+
+                    if columnar_formats:
+                        # The first chunk fixes the arrow schema of the columnar outputs
+                        table = to_arrow_table(chunk, allowed_values)
+                        if schema is None:
+                            schema = table.schema
+                            for fmt in columnar_formats:
+                                writers[fmt] = stack.enter_context(
+                                    open_columnar_writer(fmt, staging_paths[fmt], schema)
+                                )
+                        for fmt in columnar_formats:
+                            writers[fmt].write_table(table.cast(schema))
+                counts["written"] += len(chunk)
+
+            items = enumerate(staged_iter("01_read", chunks))
+            if overlap_queue is None:
+                for item in items:
+                    write_chunk(process_chunk(item))
+            else:
+                utilization = run_overlapped(items, process_chunk, write_chunk, overlap_queue)
+                instrumentation.add_totals("overlap", {
+                    "wall_seconds": utilization["wall_seconds"],
+                    **{f"{name}_{key}": value
+                       for name in ("read", "process", "write")
+                       for key, value in utilization[name].items()
+                       if key != "utilization"},
+                })
+
+        if collect_all or max_reject_rate is not None:
+            violations = sorted(report.values(), key=violation_order)
+            if report_path is not None:
+                write_violation_report(report_path, counts["read"], violations)
+            if max_reject_rate is not None:
+                check_reject_rate(counts["rejected"], counts["read"], max_reject_rate)
+            elif violations:
+                raise ValueError(summarize_violations(violations))
+
+        for fmt, staging_path in staging_paths.items():
+            os.replace(staging_path, final_paths[fmt])
+    finally:
+        for staging_path in staging_paths.values():
+            staging_path.unlink(missing_ok=True)
+        if cache_path is not None:
+            save_validation_cache(cache_path, passed_blocks, ruleset)
+
+    return counts["written"]
+
+# Raw files of a multi-file run: a single file, every file of a directory matching one of RAW_FILE_PATTERNS, or the
+# files matching a glob pattern (** matches nested directories), sorted by path. Raises ValueError when nothing matches.
+def resolve_raw_paths(pattern: str) -> list:
+    path = Path(pattern)
+    if path.is_dir():
+        paths = (match for file_pattern in RAW_FILE_PATTERNS for match in path.glob(file_pattern))
+    else:
+        paths = (Path(match) for match in glob.glob(pattern, recursive=True))
+    paths = sorted(path for path in paths if path.is_file())
+    if not paths:
+        raise ValueError(f"Reading failed: no raw files match '{pattern}'.")
+    return paths
+
+# Split the raw file after its header line into n_shards byte ranges that start and end on line boundaries
+def shard_offsets(raw_path: Path, n_shards: int) -> list:
+    size = raw_path.stat().st_size
+    with open(raw_path, "rb") as f:
+        data_start = len(f.readline())
+        bounds = [data_start]
+        for shard in range(1, n_shards):
+            target = data_start + (size - data_start) * shard // n_shards
+            # Move to the start of the first line at or after the target offset
+            f.seek(max(target - 1, bounds[-1]))
+            f.readline()
+            if bounds[-1] < f.tell() < size:
+                bounds.append(f.tell())
+        bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# Row number within its raw file of the first row of every (raw_path, start, end) shard, counted from the newlines
+# between consecutive shard starts in one sequential pass over each file; a compressed file is one shard at row 0
+def shard_first_rows(shards: list) -> list:
+    first_rows = []
+    positions = {}
+    for raw_path, start, end in shards:
+        if compression_codec(raw_path) is not None:
+            first_rows.append(0)
+            continue
+        with open(raw_path, "rb") as f:
+            offset, row = positions.get(raw_path, (len(f.readline()), 0))
+            f.seek(offset)
+            while offset < start:
+                block = f.read(min(start - offset, CACHE_BLOCK_BYTES))
+                if not block:
+                    break
+                row += block.count(b"\n")
+                offset += len(block)
+        positions[raw_path] = (start, row)
+        first_rows.append(row)
+    return first_rows
+
+# Multi-file input: put the columns of a cleaned (or rejected) data frame in the order of EXPECTED_DTYPES, followed
+# by extra_columns, and add the raw file path as SOURCE_COLUMN, so the rows of different files line up. A column the
+# file lacks (a collect-all run that fails on it) is filled with missing values.
+def tag_source_file(df: pd.DataFrame, raw_path: Path, extra_columns: tuple = ()) -> pd.DataFrame:
+    df = df.reindex(columns=[*EXPECTED_DTYPES, *extra_columns])
+    df.insert(len(df.columns), SOURCE_COLUMN, str(raw_path))
+    return df
+
+# Parallel mode worker: parse and validate one shard of the raw file (bytes start .. end) and write its cleaned rows,
+# and rejected rows in quarantine mode, to shard files in shard_dir. The rows are numbered from first_row, their row
+# number within the raw file, so errors and violations name the same rows as a full or streaming run. Returns the row
+# counts and the violations found. With the source_column option the rows are tagged with their raw file (see
+# tag_source_file), so shards of different files line up.
+# A compressed raw file cannot be split at byte offsets and is always one whole shard.
+def process_shard(
+        raw_path: Path,
+        start: int,
+        end: int,
+        first_row: int,
+        shard_dir: Path,
+        shard_number: int,
+        options: dict
+) -> dict:
+    # Worker processes are reused across shards; report only this shard's own totals
+    instrumentation.TOTALS.clear()
+    typed = options["typed"]
+    exact_revenue = options["exact_revenue"]
+    tolerant = options["collect_all"] or options["max_reject_rate"] is not None
+    source_column = options["source_column"]
+    allowed_values = plan_allowed_values(options["rule_plan"])
+    label = f"Shard {shard_number} (bytes {start}-{end})"
+    if source_column:
+        label = f"Shard {shard_number} ({raw_path}, bytes {start}-{end})"
+
+    try:
+        if compression_codec(raw_path) is not None:
+            df = next(read_raw(raw_path, typed=typed, engine=options["engine"], tolerant=tolerant))
+        else:
+            with open(raw_path, "rb") as f:
+                header = f.readline()
+                f.seek(start)
+                block = f.read(end - start)
+            df = next(read_raw(io.BytesIO(header + block), typed=typed, engine=options["engine"], tolerant=tolerant))
+    except ValueError as e:
+        raise ValueError(f"{label}: {e}") from e
+    df.index = pd.RangeIndex(first_row, first_row + len(df))
+    rows_read = len(df)
+    rejects = None
+    violations = []
+
+    try:
+        if options["max_reject_rate"] is not None:
+            df, rejects, violations = quarantine_rows(df, TOLERANCE, typed=typed, exact_revenue=exact_revenue)
+        elif options["collect_all"]:
+            df, violations = collect_violations(df, TOLERANCE, typed=typed, exact_revenue=exact_revenue)
+        else:
+            df = validate_frame(
+                df,
+                fused=options["fused"],
+                typed=typed,
+                threads=options["threads"],
+                exact_revenue=exact_revenue,
+                infer_revenue=options["infer_revenue"],
+                rule_plan=options["rule_plan"],
+            )
+        df = normalize_allowed_columns(df, allowed_values)
+        if options["compact"] and not (options["collect_all"] and violations):
+            df = compact_frame(df, allowed_values)
+        if source_column:
+            df = tag_source_file(df, raw_path)
+            if rejects is not None:
+                rejects = tag_source_file(rejects, raw_path, (REJECT_REASON_COLUMN,))
+    except ValueError as e:
+        raise ValueError(f"{label}: {e}") from e
+
+    for output_format in options["output_formats"]:
+        shard_path = shard_dir / f"shard_{shard_number:05d}.{output_format}"
+        if output_format == "csv":
+            write_clean_csv(df, shard_path)
+        else:
+            write_clean_columnar(df, shard_path, output_format, allowed_values)
+    if rejects is not None:
+        write_clean_csv(rejects, shard_dir / f"shard_{shard_number:05d}.rejects")
+
+    return {
+        "rows_read": rows_read,
+        "rows_written": len(df),
+        "rows_rejected": len(rejects) if rejects is not None else 0,
+        "violations": violations,
+        "rule_schedule": instrumentation.TOTALS.get("rule_schedule"),
+        "rule_plan": instrumentation.TOTALS.get("rule_plan"),
+        "revenue_formulas": instrumentation.TOTALS.get("revenue_formulas"),
+        "compact": instrumentation.TOTALS.get("compact"),
+    }
+
+# Concatenate the shard files of one output format, in shard order, into target. Csv shards are joined as bytes,
+# dropping the header line of every shard but the first, and compressed with the given codec; columnar shards are
+# appended table by table.
+def merge_shard_files(output_format: str, shard_paths: list, target: Path, compression: Optional[str] = None) -> None:
+    if output_format in ("csv", "rejects"):
+        with open_compressed(target, "wb", compression) as out:
+            for shard_number, shard_path in enumerate(shard_paths):
+                with open(shard_path, "rb") as shard:
+                    if shard_number:
+                        shard.readline()
+                    shutil.copyfileobj(shard, out)
+        return
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    def read_shard(path: Path):
+        if output_format == "parquet":
+            return pq.read_table(path)
+        with pa.memory_map(str(path)) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    first = read_shard(shard_paths[0])
+    with open_columnar_writer(output_format, target, first.schema) as writer:
+        writer.write_table(first)
+        for shard_path in shard_paths[1:]:
+            writer.write_table(read_shard(shard_path).cast(first.schema))
+
+# Parallel mode: split the raw files into newline-aligned shards, parse and validate them in a pool of worker
+# processes and merge the per-shard outputs and violation summaries in the parent. As in streaming mode, the outputs
+# are published only after every shard has passed. In fail-on-first mode the error of the first failing shard (in
+# file order) is raised, with the row numbers of the raw file (see shard_first_rows); in collect-all and quarantine
+# mode the violations of all shards are merged, with the same row numbers and, when there are several raw files or
+# source_column is set, the raw file of every sampled row in sample_files. Every file is split into at
+# least workers / len(raw_paths) shards and shards of at most about SHARD_BYTES. With source_column (multi-file mode)
+# the rows are tagged with their raw file, see process_shard. Compressed raw files are one shard each; the csv
+# shards are written uncompressed and compressed while they are merged.
+def run_parallel(
+        raw_paths: list,
+        out_path: Path,
+        workers: int,
+        fused: bool = False,
+        typed: bool = True,
+        engine: str = "c",
+        output_formats: tuple = ("csv",),
+        collect_all: bool = False,
+        report_path: Optional[str] = None,
+        max_reject_rate: Optional[float] = None,
+        threads: Optional[int] = None,
+        exact_revenue: bool = False,
+        infer_revenue: bool = False,
+        compact: bool = False,
+        rule_plan: Optional[dict] = None,
+        source_column: bool = False,
+        compression: Optional[str] = None
+) -> int:
+    if workers <= 0:
+        raise ValueError(f"Parallel mode failed: number of workers must be positive, got {workers}.")
+
+    shards = []
+    for raw_path in raw_paths:
+        if compression_codec(raw_path) is not None:
+            shards.append((raw_path, 0, raw_path.stat().st_size))
+            continue
+        n_shards = max(workers // len(raw_paths), -(-raw_path.stat().st_size // SHARD_BYTES), 1)
+        shards.extend((raw_path, start, end) for start, end in shard_offsets(raw_path, n_shards))
+    first_rows = shard_first_rows(shards)
+    options = {
+        "fused": fused,
+        "typed": typed,
+        "engine": engine,
+        "output_formats": output_formats,
+        "collect_all": collect_all,
+        "max_reject_rate": max_reject_rate,
+        "threads": threads,
+        "exact_revenue": exact_revenue,
+        "infer_revenue": infer_revenue,
+        "compact": compact,
+        "rule_plan": rule_plan,
+        "source_column": source_column,
+    }
+
+    final_paths = {fmt: output_path(out_path, fmt, compression) for fmt in output_formats}
+    if max_reject_rate is not None:
+        final_paths["rejects"] = rejects_path(out_path, compression)
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=out_path.parent, prefix=".shards-") as tmp:
+        shard_dir = Path(tmp)
+
+        with stage("01-18_parallel_shards"):
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    pool.submit(
+                        process_shard, raw_path, start, end, first_rows[shard_number], shard_dir, shard_number, options
+                    )
+                    for shard_number, (raw_path, start, end) in enumerate(shards)
+                ]
+                try:
+                    results = [future.result() for future in futures]
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        report = {}
+        name_files = source_column or len(raw_paths) > 1
+        for shard_number, result in enumerate(results):
+            violations = result["violations"]
+            if name_files:
+                raw_path = str(shards[shard_number][0])
+                violations = [dict(v, sample_files=[raw_path] * len(v["sample_rows"])) for v in violations]
+            merge_violations(report, violations)
+            if result["rule_schedule"]:
+                instrumentation.add_totals("rule_schedule", result["rule_schedule"])
+            if result["rule_plan"]:
+                instrumentation.add_totals("rule_plan", result["rule_plan"])
+            if result["revenue_formulas"]:
+                instrumentation.add_totals("revenue_formulas", result["revenue_formulas"])
+            if result["compact"]:
+                instrumentation.add_totals("compact", result["compact"])
+
+        rows_written = sum(result["rows_written"] for result in results)
+        rows_read = sum(result["rows_read"] for result in results)
+        rows_rejected = sum(result["rows_rejected"] for result in results)
+        if collect_all or max_reject_rate is not None:
+            violations = sorted(report.values(), key=violation_order)
+            if report_path is not None:
+                write_violation_report(report_path, rows_read, violations)
+            if max_reject_rate is not None:
+                check_reject_rate(rows_rejected, rows_read, max_reject_rate)
+            elif violations:
+                raise ValueError(summarize_violations(violations))
+
+        with stage("19_write"):
+            staging_paths = {fmt: path.with_name(path.name + ".staging") for fmt, path in final_paths.items()}
+            try:
+                for fmt, staging_path in staging_paths.items():
+                    shard_paths = [shard_dir / f"shard_{n:05d}.{fmt}" for n in range(len(shards))]
+                    merge_shard_files(fmt, shard_paths, staging_path, compression)
+                for fmt, staging_path in staging_paths.items():
+                    os.replace(staging_path, final_paths[fmt])
+            finally:
+                for staging_path in staging_paths.values():
+                    staging_path.unlink(missing_ok=True)
+
+    return rows_written
+
+def parse_args(argv: Optional[list] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Validate raw supplement sales data and write the cleaned csv file.")
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help="Streaming mode: validate the raw file in chunks of this many rows instead of loading it whole.",
+    )
+    parser.add_argument(
+        "--fused",
+        action="store_true",
+        help="Run the numeric rules (steps 7-14) through the single-pass fused validator.",
+    )
+    parser.add_argument(
+        "--exact-revenue",
+        action="store_true",
+        help="Check the revenue formulas (steps 11-14) exactly in integer cents and discount basis points instead of "
+             "with float tolerances.",
+    )
+    parser.add_argument(
+        "--parsed-cache",
+        action="store_true",
+        help="Memory-map the parsed columns from a binary sidecar cache next to the raw file instead of parsing the "
+             "csv file; the cache is (re)written whenever the raw file changed.",
+    )
+    parser.add_argument(
+        "--rules",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help="Run steps 5-16 from a declarative rule spec file (TOML, see scripts/rules.toml) compiled into an "
+             "execution plan, instead of the built-in validators.",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Downcast the validated data to the compact schema (uint16/uint8 units, float32 prices, revenues and "
+             "discounts, int8 category codes), verified lossless, before it is written.",
+    )
+    parser.add_argument(
+        "--infer-revenue-formula",
+        action="store_true",
+        help="Infer the dominant revenue formula from a sample, check every row against it first and the other "
+             "formulas only for the rows it misses, and report which formula holds per Platform / Location.",
+    )
+    parser.add_argument(
+        "--infer-dtypes",
+        action="store_true",
+        help="Let pandas infer column types instead of reading with the explicit dtype map and fixed date format.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=READER_ENGINES,
+        default="c",
+        help="Csv parser for the raw file: pandas C engine (default), multithreaded pyarrow or pure-Python fallback.",
+    )
+    parser.add_argument(
+        "--output-format",
+        nargs="+",
+        choices=OUTPUT_FORMATS,
+        default=["csv"],
+        help="Cleaned output formats; parquet and feather (Arrow IPC) are written next to the cleaned csv file.",
+    )
+    parser.add_argument(
+        "--partition-by",
+        nargs="*",
+        choices=PARTITION_COLUMNS,
+        default=None,
+        help="Write the output partitioned by year/week of Date, and optionally by Location and / or Platform, "
+             "with a manifest of partitions, row counts and content hashes (not available in streaming mode).",
+    )
+    parser.add_argument(
+        "--validation-cache",
+        action="store_true",
+        help="Stream the raw file in newline-aligned blocks and re-validate only blocks that are new or changed "
+             "since the last run, or that were validated under a different rule set.",
+    )
+    parser.add_argument(
+        "--skip-unchanged",
+        action="store_true",
+        help="Exit immediately, without reading the data, if the raw file, the rules, the options and the outputs "
+             "are unchanged since the last successful run.",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        default=None,
+        help="Record wall time, CPU time, peak RSS and tracemalloc deltas of every pipeline step and write them as "
+             "JSON to this path ('-' for stdout).",
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        default=None,
+        help="Also write the per-step measurements as a Prometheus textfile to this path.",
+    )
+    parser.add_argument(
+        "--collect-all",
+        action="store_true",
+        help="Evaluate every rule instead of stopping at the first failure, and report all violations at once; "
+             "no output is written if any rule fails.",
+    )
+    parser.add_argument(
+        "--report",
+        default=None,
+        help="With --collect-all, write the violation report (rule, column, count, sampled rows) as JSON to this "
+             "path ('-' for stdout).",
+    )
+    parser.add_argument(
+        "--quarantine",
+        action="store_true",
+        help="Move rows that fail the Units Returned, Price, Discount, Revenue or allowed value checks to a rejects "
+             "file with their failure reasons and write all other rows to the cleaned output.",
+    )
+    parser.add_argument(
+        "--max-reject-rate",
+        type=float,
+        default=MAX_REJECT_RATE,
+        help=f"With --quarantine, fail the run if more than this share of rows is rejected (default {MAX_REJECT_RATE}).",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Parallel mode: split the raw file into newline-aligned shards and parse and validate them in this many "
+             "worker processes.",
+    )
+    parser.add_argument(
+        "--input",
+        default=None,
+        metavar="PATH",
+        help=f"Multi-file mode: read a raw file, every {', '.join(RAW_FILE_PATTERNS)} file of a directory or the "
+             f"files matching a glob pattern instead of {RAW_PATH}, process them concurrently (--workers, default one "
+             f"per file up to the number of CPUs) and write one combined output with a '{SOURCE_COLUMN}' column. "
+             f"A single file can also be streamed (--chunk-size, --validation-cache).",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=tuple(COMPRESSION_SUFFIXES),
+        default=None,
+        metavar="CODEC",
+        help=f"Write the cleaned csv file (and the rejects file) compressed with this codec "
+             f"({', '.join(COMPRESSION_SUFFIXES)}; zstd requires the zstandard package).",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Run the independent rule groups of steps 5-16 concurrently on a thread pool of this size and report "
+             "the critical path time.",
+    )
+    parser.add_argument(
+        "--overlap",
+        type=int,
+        default=None,
+        metavar="QUEUE_SIZE",
+        help="Streaming mode: overlap reading, validating and writing chunks in separate threads connected by "
+             "bounded queues of this many chunks, and report the utilization of each stage.",
+    )
+    return parser.parse_args(argv)
+
+def main(argv: Optional[list] = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+
+    if args.engine == "pyarrow" and importlib.util.find_spec("pyarrow") is None:
+        print("The pyarrow reader engine requires the pyarrow package.", file=sys.stderr)
+        sys.exit(1)
+
+    output_formats = tuple(dict.fromkeys(args.output_format))
+    if set(output_formats) - {"csv"} and importlib.util.find_spec("pyarrow") is None:
+        print("Parquet and feather output require the pyarrow package.", file=sys.stderr)
+        sys.exit(1)
+
+    partition_by = tuple(args.partition_by) if args.partition_by is not None else None
+    if partition_by is not None and args.compress is not None:
+        print("Partitioned output (--partition-by) cannot be compressed (--compress).", file=sys.stderr)
+        sys.exit(1)
+
+    streaming = args.chunk_size is not None or args.validation_cache
+    if partition_by is not None and streaming:
+        print("Partitioned output is not available in streaming mode (--chunk-size, --validation-cache).", file=sys.stderr)
+        sys.exit(1)
+
+    rule_plan = None
+    rules_state = None
+    if args.rules is not None:
+        incompatible = [
+            flag for flag, used in (
+                ("--fused", args.fused),
+                ("--threads", args.threads is not None),
+                ("--exact-revenue", args.exact_revenue),
+                ("--infer-revenue-formula", args.infer_revenue_formula),
+                ("--collect-all", args.collect_all),
+                ("--quarantine", args.quarantine),
+            ) if used
+        ]
+        if incompatible:
+            print(f"A rule spec file (--rules) cannot be combined with {', '.join(incompatible)}.", file=sys.stderr)
+            sys.exit(1)
+        if importlib.util.find_spec("tomllib") is None:
+            print("A rule spec file (--rules) requires Python 3.11 or newer (tomllib).", file=sys.stderr)
+            sys.exit(1)
+        try:
+            if args.skip_unchanged:
+                rules_state = file_state(args.rules)
+            rule_plan = compile_rule_plan(load_rule_spec(args.rules))
+        except (OSError, ValueError) as e:
+            print(f"Loading the rule spec failed. {e}", file=sys.stderr)
+            sys.exit(1)
+
+    if args.infer_revenue_formula and (args.fused or args.exact_revenue or args.collect_all or args.quarantine):
+        print("Revenue formula inference (--infer-revenue-formula) cannot be combined with --fused, --exact-revenue, "
+              "--collect-all or --quarantine.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.overlap is not None and not streaming:
+        print("Overlapped pipeline (--overlap) requires streaming mode (--chunk-size or --validation-cache).",
+              file=sys.stderr)
+        sys.exit(1)
+
+    if args.parsed_cache and (
+            streaming or args.workers is not None or args.infer_dtypes or args.collect_all or args.quarantine
+    ):
+        print("The parsed cache (--parsed-cache) is available for whole-file runs with typed reads only, not with "
+              "--chunk-size, --validation-cache, --workers, --infer-dtypes, --collect-all or --quarantine.",
+              file=sys.stderr)
+        sys.exit(1)
+
+    if args.workers is not None and (streaming or partition_by is not None):
+        print("Parallel mode (--workers) cannot be combined with --chunk-size, --validation-cache or --partition-by.",
+              file=sys.stderr)
+        sys.exit(1)
+
+    raw_paths = [RAW_PATH]
+    workers = args.workers
+    if args.input is not None:
+        if partition_by is not None or args.parsed_cache or args.skip_unchanged:
+            print("Multi-file input (--input) cannot be combined with --partition-by, --parsed-cache or "
+                  "--skip-unchanged.", file=sys.stderr)
+            sys.exit(1)
+        try:
+            raw_paths = resolve_raw_paths(args.input)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        if streaming and len(raw_paths) > 1:
+            print(f"Streaming mode (--chunk-size, --validation-cache) reads a single raw file, but --input matches "
+                  f"{len(raw_paths)} files.", file=sys.stderr)
+            sys.exit(1)
+        if workers is None and not streaming:
+            workers = min(len(raw_paths), os.cpu_count() or 1)
+
+    uses_zstd = args.compress == "zstd" or any(compression_codec(path) == "zstd" for path in raw_paths)
+    if uses_zstd and importlib.util.find_spec("zstandard") is None:
+        print("Reading or writing zstd compressed files requires the zstandard package.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.metrics_json is not None or args.metrics_prom is not None:
+        instrumentation.enable()
+
+    try:
+        # State of the raw file before it is read, for the run manifest
+        if args.skip_unchanged:
+            raw_state = file_state(RAW_PATH)
+        if workers is not None:
+            rows_written = run_parallel(
+                raw_paths,
+                CLEAN_PATH,
+                workers,
+                fused=args.fused,
+                typed=not args.infer_dtypes,
+                engine=args.engine,
+                output_formats=output_formats,
+                collect_all=args.collect_all,
+                report_path=args.report,
+                max_reject_rate=args.max_reject_rate if args.quarantine else None,
+                threads=args.threads,
+                exact_revenue=args.exact_revenue,
+                infer_revenue=args.infer_revenue_formula,
+                compact=args.compact,
+                rule_plan=rule_plan,
+                source_column=args.input is not None,
+                compression=args.compress
+            )
+        elif streaming:
+            rows_written = run_streaming(
+                raw_paths[0],
+                CLEAN_PATH,
+                args.chunk_size,
+                fused=args.fused,
+                typed=not args.infer_dtypes,
+                engine=args.engine,
+                output_formats=output_formats,
+                cache_path=validation_cache_path(raw_paths[0]) if args.validation_cache else None,
+                collect_all=args.collect_all,
+                report_path=args.report,
+                max_reject_rate=args.max_reject_rate if args.quarantine else None,
+                threads=args.threads,
+                overlap_queue=args.overlap,
+                exact_revenue=args.exact_revenue,
+                infer_revenue=args.infer_revenue_formula,
+                compact=args.compact,
+                rule_plan=rule_plan,
+                source_column=args.input is not None,
+                compression=args.compress
+            )
+        else:
+            rows_written = run_full(
+                RAW_PATH,
+                CLEAN_PATH,
+                fused=args.fused,
+                typed=not args.infer_dtypes,
+                engine=args.engine,
+                output_formats=output_formats,
+                partition_by=partition_by,
+                collect_all=args.collect_all,
+                report_path=args.report,
+                max_reject_rate=args.max_reject_rate if args.quarantine else None,
+                threads=args.threads,
+                exact_revenue=args.exact_revenue,
+                infer_revenue=args.infer_revenue_formula,
+                compact=args.compact,
+                rule_plan=rule_plan,
+                parsed_cache=args.parsed_cache,
+                compression=args.compress
+            )
+    except (OSError, ValueError) as e:
+        print(f"Validation failed. {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if args.metrics_json is not None:
+            instrumentation.write_json(args.metrics_json)
+        if args.metrics_prom is not None:
+            instrumentation.write_prometheus(args.metrics_prom)
+
+    if partition_by is not None:
+        written_paths = f"partitions under {partition_root(CLEAN_PATH)}"
+        output_files = [partition_root(CLEAN_PATH) / MANIFEST_NAME]
+    else:
+        output_files = [output_path(CLEAN_PATH, fmt, args.compress) for fmt in output_formats]
+        written_paths = ", ".join(str(path) for path in output_files)
+
+    if args.quarantine:
+        output_files.append(rejects_path(CLEAN_PATH, args.compress))
+        written_paths += f" (rejected rows in {rejects_path(CLEAN_PATH, args.compress)})"
+
+    if args.skip_unchanged:
+        write_run_manifest(
+            raw_state, output_files, ruleset_fingerprint(args.exact_revenue, rule_plan), Path(__file__), argv,
+            rules_state
+        )
+    if args.input is None:
+        print(f"Validation passed. {rows_written} rows written to {written_paths}")
+    else:
+        print(f"Validation passed. {rows_written} rows from {len(raw_paths)} raw files written to {written_paths}")
+
+    overlap = instrumentation.TOTALS.get("overlap")
+    if overlap:
+        print("Overlapped pipeline: " + ", ".join(
+            f"{name} {overlap[f'{name}_busy_seconds'] / overlap['wall_seconds']:.0%} busy"
+            for name in ("read", "process", "write")
+        ) + f" over {overlap['wall_seconds']:.3f} s.")
+
+    schedule = instrumentation.TOTALS.get("rule_schedule")
+    if schedule:
+        print(
+            f"Rule scheduler: {schedule['serial_seconds']:.3f} s of rule work, critical path "
+            f"{schedule['critical_path_seconds']:.3f} s, wall {schedule['wall_seconds']:.3f} s."
+        )
+
+    compacted = instrumentation.TOTALS.get("compact")
+    if compacted:
+        print(
+            f"Compact schema: {compacted['bytes_before'] / 2**20:.2f} MiB -> {compacted['bytes_after'] / 2**20:.2f} MiB "
+            f"in memory ({compacted['bytes_before'] / max(compacted['bytes_after'], 1):.1f}x smaller)."
+        )
+
+    formulas = instrumentation.TOTALS.get("revenue_formulas")
+    if formulas:
+        segments = {}
+        for key, rows in formulas.items():
+            platform, location, formula = key.split("|")
+            segments.setdefault((platform, location), {})[formula] = rows
+        print("Revenue formulas per Platform / Location:")
+        for (platform, location), counts in sorted(segments.items()):
+            total = sum(counts.values())
+            shares = ", ".join(
+                f"{formula} {rows / total:.1%}" for formula, rows in sorted(counts.items(), key=lambda item: -item[1])
+            )
+            print(f"  {platform} / {location} ({total} rows): {shares}")
 
-main()
 
-if _name_ == "_main_": main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
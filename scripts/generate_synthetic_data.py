@@ -0,0 +1,220 @@
+# Purpose of the script: generate synthetic weekly supplement sales data at any size, for scaling tests.
+
+# Output: a csv file with the raw data schema (REQUIRED_COLUMNS, same column order as the Kaggle sample) whose string
+# columns use only the ALLOWED_* vocabularies of clean_and_validate.py and whose numeric columns follow the ranges of
+# the sample. Rows are generated and written in chunks, so sizes of 1e9 rows need only chunk-sized memory.
+# The same seed and size always produce the same file.
+
+# Errors can be injected at a controllable rate per error kind (see ERROR_KINDS), e.g. --error-rate
+# revenue_mismatch=0.001 --error-rate unknown_location=0.0001 makes 0.1% of the rows fail the revenue check and 0.01%
+# the Location check.
+
+# Usage (from the repository root): python scripts/generate_synthetic_data.py data/synthetic/raw_1e6.csv --rows 1e6
+
+# Imports
+from pathlib import Path
+from typing import Optional
+import argparse
+
+import numpy as np
+import pandas as pd
+
+import clean_and_validate as cv
+
+# Constants
+
+# Column order of the raw data file
+COLUMN_ORDER = [
+    "Date", 
+    "Product Name", 
+    "Category", 
+    "Units Sold", 
+    "Price", 
+    "Revenue", 
+    "Discount", 
+    "Units Returned", 
+    "Location", 
+    "Platform"
+]
+
+# Category of each product, as in the Kaggle sample
+PRODUCT_CATEGORIES = {
+    "Whey Protein": "Protein", 
+    "Vitamin C": "Vitamin", 
+    "Fish Oil": "Omega", 
+    "Multivitamin": "Vitamin", 
+    "Pre-Workout": "Performance", 
+    "BCAA": "Amino Acid", 
+    "Creatine": "Performance", 
+    "Zinc": "Mineral", 
+    "Collagen Peptides": "Protein", 
+    "Magnesium": "Mineral", 
+    "Ashwagandha": "Herbal", 
+    "Melatonin": "Sleep Aid", 
+    "Biotin": "Vitamin", 
+    "Green Tea Extract": "Fat Burner", 
+    "Iron Supplement": "Mineral", 
+    "Electrolyte Powder": "Hydration"
+}
+
+FIRST_WEEK = pd.Timestamp("2020-01-06")
+
+# Error kinds that can be injected. Each one breaks exactly one validation rule, except negative_units_sold, which also
+# breaks units_returned_exceed_sold: Units Returned is never negative, so it exceeds a negative Units Sold. Revenue is
+# recomputed for the rows whose Units Sold or Price is changed, so they still match the revenue formula.
+ERROR_KINDS = (
+    "bad_date",
+    "missing_value",
+    "unknown_product",
+    "unknown_category",
+    "negative_units_sold",
+    "returned_exceed_sold",
+    "non_positive_price",
+    "discount_out_of_range",
+    "revenue_mismatch",
+    "unknown_location",
+    "unknown_platform",
+)
+
+CHUNK_ROWS = 1_000_000
+
+# Functions
+
+# Generate rows start_row .. start_row + n_rows - 1. Rows are spread evenly over the weeks starting at FIRST_WEEK,
+# rows_per_week at a time, so the file is ordered by Date like the sample.
+def generate_chunk(
+        rng: np.random.Generator,
+        start_row: int,
+        n_rows: int,
+        rows_per_week: int,
+        error_rates: dict
+) -> pd.DataFrame:
+    products = np.array(sorted(PRODUCT_CATEGORIES))
+    categories = np.array([PRODUCT_CATEGORIES[p] for p in products])
+    locations = np.array(sorted(cv.ALLOWED_LOCATIONS))
+    platforms = np.array(sorted(cv.ALLOWED_PLATFORMS))
+
+    rows = np.arange(start_row, start_row + n_rows)
+    weeks = rows // rows_per_week
+    dates = (FIRST_WEEK + pd.to_timedelta(weeks * 7, unit="D")).strftime(cv.DATE_FORMAT).to_numpy(dtype=object)
+
+    product_codes = rows % len(products)
+    units_sold = np.clip(np.rint(rng.normal(150, 12, n_rows)), 0, None).astype(np.int64)
+    price = np.round(rng.uniform(10, 60, n_rows), 2)
+    discount = np.round(rng.uniform(0, 0.25, n_rows), 2)
+    units_returned = np.minimum(rng.poisson(1.5, n_rows), units_sold)
+
+    df = pd.DataFrame({
+        "Date": dates,
+        "Product Name": products[product_codes].astype(object),
+        "Category": categories[product_codes].astype(object),
+        "Units Sold": pd.array(units_sold, dtype="Int64"),
+        "Price": price,
+        "Revenue": np.round(units_sold * price, 2),
+        "Discount": discount,
+        "Units Returned": pd.array(units_returned, dtype="Int64"),
+        "Location": locations[rng.integers(0, len(locations), n_rows)].astype(object),
+        "Platform": platforms[rng.integers(0, len(platforms), n_rows)].astype(object),
+    })
+
+    # Rows whose Revenue is recomputed from the injected Units Sold or Price, and rows with a deliberate revenue mismatch
+    recompute_revenue = np.zeros(n_rows, dtype=bool)
+    revenue_mismatch = np.zeros(n_rows, dtype=bool)
+
+    for kind, rate in error_rates.items():
+        hit = rng.random(n_rows) < rate
+        if not hit.any():
+            continue
+        if kind == "bad_date":
+            df.loc[hit, "Date"] = "2020-13-45"
+        elif kind == "missing_value":
+            df.loc[hit, "Location"] = None
+        elif kind == "unknown_product":
+            df.loc[hit, "Product Name"] = "Unknown Product"
+        elif kind == "unknown_category":
+            df.loc[hit, "Category"] = "Unknown Category"
+        elif kind == "negative_units_sold":
+            df.loc[hit, "Units Sold"] = -df.loc[hit, "Units Sold"] - 1
+            recompute_revenue |= hit
+        elif kind == "returned_exceed_sold":
+            df.loc[hit, "Units Returned"] = df.loc[hit, "Units Sold"] + 1
+        elif kind == "non_positive_price":
+            df.loc[hit, "Price"] = 0.0
+            recompute_revenue |= hit
+        elif kind == "discount_out_of_range":
+            df.loc[hit, "Discount"] = 1.5
+        elif kind == "revenue_mismatch":
+            df.loc[hit, "Revenue"] = np.round(df.loc[hit, "Revenue"] * 1.1 + 1, 2)
+            revenue_mismatch |= hit
+        elif kind == "unknown_location":
+            df.loc[hit, "Location"] = "Atlantis"
+        elif kind == "unknown_platform":
+            df.loc[hit, "Platform"] = "Unknown Shop"
+
+    recompute_revenue &= ~revenue_mismatch
+    if recompute_revenue.any():
+        units_sold = df.loc[recompute_revenue, "Units Sold"].to_numpy(dtype=np.float64)
+        df.loc[recompute_revenue, "Revenue"] = np.round(units_sold * df.loc[recompute_revenue, "Price"].to_numpy(), 2)
+
+    return df[COLUMN_ORDER]
+
+# Write n_rows synthetic rows to out_path in chunks of chunk_rows. Every chunk gets its own random stream derived
+# from the seed and the chunk number, so the output depends only on seed, n_rows, weeks and chunk_rows.
+def generate(
+        out_path: Path,
+        n_rows: int,
+        seed: int = 0,
+        error_rates: Optional[dict] = None,
+        weeks: int = 274,
+        chunk_rows: int = CHUNK_ROWS
+) -> None:
+    error_rates = error_rates or {}
+    unknown = set(error_rates) - set(ERROR_KINDS)
+    if unknown:
+        raise ValueError(f"Unknown error kinds {sorted(unknown)}, expected any of {ERROR_KINDS}.")
+
+    rows_per_week = max(1, -(-n_rows // weeks))
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(out_path, "w", newline="") as f:
+        for chunk_number, start_row in enumerate(range(0, n_rows, chunk_rows)):
+            rng = np.random.default_rng([seed, chunk_number])
+            chunk = generate_chunk(rng, start_row, min(chunk_rows, n_rows - start_row), rows_per_week, error_rates)
+            chunk.to_csv(f, header=(chunk_number == 0), index=False)
+
+# Parse KIND=RATE pairs of the --error-rate option
+def parse_error_rates(pairs: list) -> dict:
+    rates = {}
+    for pair in pairs:
+        kind, _, rate = pair.partition("=")
+        if kind not in ERROR_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown error kind '{kind}', expected one of {ERROR_KINDS}")
+        rates[kind] = float(rate)
+    return rates
+
+def main(argv: Optional[list] = None) -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic supplement sales data.")
+    parser.add_argument("out_path", type=Path, help="Csv file to write.")
+    parser.add_argument("--rows", type=float, default=1e5, help="Number of rows, e.g. 1e5 ... 1e9.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--weeks", type=int, default=274, help="Number of weeks the rows are spread over.")
+    parser.add_argument(
+        "--error-rate",
+        action="append",
+        default=[],
+        metavar="KIND=RATE",
+        help=f"Fraction of rows with an injected error of the given kind; kinds: {', '.join(ERROR_KINDS)}.",
+    )
+    args = parser.parse_args(argv)
+
+    try:
+        error_rates = parse_error_rates(args.error_rate)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    generate(args.out_path, int(args.rows), seed=args.seed, error_rates=error_rates, weeks=args.weeks)
+    print(f"{int(args.rows)} rows written to {args.out_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# Purpose of the module: per-step timing and memory instrumentation for clean_and_validate.py.
+
+# Each pipeline step (1-19 in the header of clean_and_validate.py) runs inside stage(name). When instrumentation is
+# enabled, every stage records wall time, CPU time, the peak RSS of the process, the growth of the peak RSS during the
+# step, and the tracemalloc allocation delta and peak of the step. In streaming mode a step runs once per chunk and
+# its measurements are accumulated (times and deltas summed, peaks maximised). The results are written as JSON and,
+# optionally, as a Prometheus textfile for the node exporter textfile collector.
+
+# Imports
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS is then not reported
+    resource = None
+
+# Constants
+PROMETHEUS_PREFIX = "supplement_pipeline_step"
+
+# Module state: instrumentation is off until enable() is called, and stage() is then a no-op
+ENABLED = False
+STAGES = {}
+TOTALS = {}
+
+# Functions
+
+# Peak resident set size of the process in bytes (ru_maxrss is in kilobytes on Linux and in bytes on macOS)
+def peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Turn instrumentation on and clear earlier measurements; tracemalloc is started for the allocation deltas
+def enable(trace_memory: bool = True) -> None:
+    global ENABLED
+    ENABLED = True
+    STAGES.clear()
+    TOTALS.clear()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+# Measure one pipeline step
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    if not ENABLED:
+        yield
+        return
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        traced_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    rss_before = peak_rss_bytes()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        rss_after = peak_rss_bytes()
+
+        stats = STAGES.setdefault(name, {
+            "calls": 0,
+            "wall_seconds": 0.0,
+            "cpu_seconds": 0.0,
+            "peak_rss_bytes": None,
+            "peak_rss_growth_bytes": None,
+            "tracemalloc_delta_bytes": None,
+            "tracemalloc_peak_bytes": None,
+        })
+        stats["calls"] += 1
+        stats["wall_seconds"] += wall
+        stats["cpu_seconds"] += cpu
+
+        if rss_after is not None:
+            stats["peak_rss_bytes"] = max(stats["peak_rss_bytes"] or 0, rss_after)
+            stats["peak_rss_growth_bytes"] = (stats["peak_rss_growth_bytes"] or 0) + rss_after - rss_before
+
+        if tracing:
+            traced_after, traced_peak = tracemalloc.get_traced_memory()
+            stats["tracemalloc_delta_bytes"] = (stats["tracemalloc_delta_bytes"] or 0) + traced_after - traced_before
+            stats["tracemalloc_peak_bytes"] = max(stats["tracemalloc_peak_bytes"] or 0, traced_peak - traced_before)
+
+# Add numeric statistics to the named running totals (for example the rule scheduler's times of every chunk).
+# Totals are recorded even when instrumentation is off, so callers can always print a summary.
+def add_totals(name: str, stats: dict) -> None:
+    totals = TOTALS.setdefault(name, {})
+    for key, value in stats.items():
+        totals[key] = totals.get(key, 0) + value
+
+# Measure every next() of an iterable as one call of the named stage (used for the chunked reader)
+def staged_iter(name: str, iterable: Iterable) -> Iterator:
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+# Measurements of all stages in the order they first ran
+def report() -> dict:
+    return {
+        "stages": {name: dict(stats) for name, stats in STAGES.items()},
+        "totals": {name: dict(totals) for name, totals in TOTALS.items()},
+    }
+
+# Write the measurements as JSON to path, or to stdout when path is "-"
+def write_json(path: str) -> None:
+    text = json.dumps(report(), indent=2)
+    if path == "-":
+        print(text)
+        return
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    Path(path).write_text(text + "\n")
+
+# Write the measurements as a Prometheus textfile; the file is replaced atomically so the collector never reads a
+# partial file
+def write_prometheus(path: str) -> None:
+    metrics = {
+        "calls": ("counter", "Number of times the step ran."),
+        "wall_seconds": ("gauge", "Wall time spent in the step."),
+        "cpu_seconds": ("gauge", "Process CPU time spent in the step."),
+        "peak_rss_bytes": ("gauge", "Peak resident set size of the process at the end of the step."),
+        "peak_rss_growth_bytes": ("gauge", "Growth of the peak resident set size during the step."),
+        "tracemalloc_delta_bytes": ("gauge", "Net Python allocations of the step."),
+        "tracemalloc_peak_bytes": ("gauge", "Peak Python allocations of the step above its starting point."),
+    }
+
+    lines = []
+    for metric, (metric_type, help_text) in metrics.items():
+        name = f"{PROMETHEUS_PREFIX}_{metric}"
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for step, stats in STAGES.items():
+            if stats[metric] is not None:
+                lines.append(f'{name}{{step="{step}"}} {stats[metric]}')
+
+    target = Path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    staging_path = target.with_name(target.name + ".staging")
+    staging_path.write_text("\n".join(lines) + "\n")
+    os.replace(staging_path, target)
@@ -0,0 +1,108 @@
+# Purpose of the module: run manifest of clean_and_validate.py and the skip-if-unchanged fast path.
+
+# After every successful run with --skip-unchanged clean_and_validate.py records the size, mtime and digest of the raw
+# data file and of the --rules file (if any) as they were before the run read them, the rule set fingerprint, the
+# digest of the script itself, the command line options and the size, mtime and digest of every output file. The next
+# run with --skip-unchanged compares the current state against the manifest and exits immediately when nothing changed.
+# Runs without the flag neither hash their files nor write the manifest. This module imports only the standard
+# library, so the check runs before pandas and numpy are imported.
+
+# Imports
+from pathlib import Path
+from typing import Optional
+import hashlib
+import json
+import os
+import sys
+
+# Constants
+RUN_MANIFEST_PATH = Path("data/cleaned/.run_manifest.json")
+
+SKIP_FLAG = "--skip-unchanged"
+
+# Functions
+
+# SHA-256 digest of a file's content
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Size, mtime and digest of a file, as stored in the manifest
+def file_state(path: Path) -> dict:
+    stat = path.stat()
+    return {"path": str(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_sha256(path)}
+
+# Check a file against its manifest entry. Size and mtime are compared first; the digest is computed only when they
+# differ, so an untouched file costs a single stat.
+def file_unchanged(entry: dict) -> bool:
+    path = Path(entry["path"])
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return False
+
+    if stat.st_size != entry["size"]:
+        return False
+    if stat.st_mtime_ns == entry["mtime_ns"]:
+        return True
+    return file_sha256(path) == entry["sha256"]
+
+# Command line options that decide what a run produces; the fast path flag itself is not part of them
+def run_options(argv: list) -> list:
+    return [arg for arg in argv if arg != SKIP_FLAG]
+
+# Record a successful run. raw_state and rules_state (for a run with a rule spec file) are the file_state of the inputs
+# taken before the run read them, so rows appended to the raw file during the run make the next check fail.
+def write_run_manifest(
+        raw_state: dict,
+        output_paths: list,
+        ruleset: str,
+        script_path: Path,
+        argv: list,
+        rules_state: Optional[dict] = None,
+        manifest_path: Path = RUN_MANIFEST_PATH
+) -> None:
+    manifest = {
+        "raw": raw_state,
+        "ruleset": ruleset,
+        "script_sha256": file_sha256(script_path),
+        "options": run_options(argv),
+        "rules": rules_state,
+        "outputs": [file_state(path) for path in output_paths],
+    }
+
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    staging_path = manifest_path.with_name(manifest_path.name + ".staging")
+    with open(staging_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(staging_path, manifest_path)
+
+# True when the previous run manifest still matches: same options, same script (which holds every built-in rule
+# constant), unchanged rule spec file (the same options name the same --rules file, so its entry in the manifest is the
+# one to check), unchanged raw file and untouched outputs. Together these keep the rule set fingerprint unchanged.
+def run_unchanged(script_path: Path, argv: list, manifest_path: Path = RUN_MANIFEST_PATH) -> bool:
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+
+    if manifest.get("options") != run_options(argv):
+        return False
+    if manifest.get("script_sha256") != file_sha256(script_path):
+        return False
+    if not manifest.get("outputs") or "rules" not in manifest:
+        return False
+    if manifest["rules"] is not None and not file_unchanged(manifest["rules"]):
+        return False
+    return file_unchanged(manifest["raw"]) and all(file_unchanged(entry) for entry in manifest["outputs"])
+
+# Fast path: when the skip flag is given and nothing changed since the last successful run, exit right away
+def exit_if_unchanged(script_path: Path, argv: Optional[list] = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+    if SKIP_FLAG in argv and run_unchanged(script_path, argv):
+        print("Skipped. Raw data, rules and outputs are unchanged since the last run.")
+        sys.exit(0)
@@ -0,0 +1,5 @@
+# The pipeline modules live in scripts/ and are imported by name, as the scripts import each other
+from pathlib import Path
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
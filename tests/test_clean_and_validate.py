@@ -0,0 +1,467 @@
+# Tests of clean_and_validate.py; run from the repository root with python -m pytest tests
+
+# Imports
+import bz2
+import gzip
+import json
+from pathlib import Path
+from types import ModuleType
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import clean_and_validate as cv
+
+# Constants
+SAMPLE_PATH = Path(__file__).resolve().parents[1] / "data" / "raw" / "Supplement_Sales_Weekly_Expanded.csv"
+
+RULES_PATH = Path(__file__).resolve().parents[1] / "scripts" / "rules.toml"
+
+# Row of the sample data that the tests break
+BAD_ROW = 3000
+
+# Fixtures
+
+# The sample raw data as text columns, so single values can be broken without type conversions
+@pytest.fixture
+def sample() -> pd.DataFrame:
+    return pd.read_csv(SAMPLE_PATH, dtype=str, keep_default_na=False)
+
+# A raw file with an invalid date in BAD_ROW
+@pytest.fixture
+def bad_date_path(sample: pd.DataFrame, tmp_path: Path) -> Path:
+    sample.loc[BAD_ROW, "Date"] = "2021-13-45"
+    path = tmp_path / "raw.csv"
+    sample.to_csv(path, index=False)
+    return path
+
+# Tests
+
+# Blocks remembered by the validation cache are discarded when the rule set changes
+def test_validation_cache_is_invalidated_by_a_rule_change(tmp_path: Path) -> None:
+    cache_path = tmp_path / "raw.csv.validation-cache.json"
+    ruleset = cv.ruleset_fingerprint()
+    cv.save_validation_cache(cache_path, {"digest"}, ruleset)
+
+    assert cv.load_validation_cache(cache_path, ruleset) == {"digest"}
+    assert cv.load_validation_cache(cache_path, cv.ruleset_fingerprint(exact_revenue=True)) == set()
+
+# Shards start right after the header, end at the end of the file, follow each other without gaps and start on line
+# boundaries; none is empty
+@pytest.mark.parametrize("n_shards", [1, 2, 3, 7, 50])
+def test_shard_offsets_cover_the_file_on_line_boundaries(n_shards: int) -> None:
+    data = SAMPLE_PATH.read_bytes()
+    shards = cv.shard_offsets(SAMPLE_PATH, n_shards)
+
+    assert shards[0][0] == data.index(b"\n") + 1
+    assert shards[-1][1] == len(data)
+    assert len(shards) <= n_shards
+    for (_, end), (start, _) in zip(shards, shards[1:]):
+        assert end == start
+        assert data[start - 1:start] == b"\n"
+    assert all(start < end for start, end in shards)
+
+# A file with fewer lines than shards gets at most one shard per line
+def test_shard_offsets_of_a_small_file(tmp_path: Path) -> None:
+    path = tmp_path / "raw.csv"
+    path.write_bytes(b"a,b\n1,2\n3,4\n")
+
+    shards = cv.shard_offsets(path, 10)
+
+    assert [path.read_bytes()[start:end] for start, end in shards] == [b"1,2\n", b"3,4\n"]
+
+# The first row of every shard is the number of data lines before it
+def test_shard_first_rows_count_the_lines_before_each_shard() -> None:
+    data = SAMPLE_PATH.read_bytes()
+    shards = [(SAMPLE_PATH, start, end) for start, end in cv.shard_offsets(SAMPLE_PATH, 7)]
+
+    first_rows = cv.shard_first_rows(shards)
+
+    assert first_rows == [data[shards[0][1]:start].count(b"\n") for _, start, _ in shards]
+
+# Full, streaming and parallel runs name the same row for a bad date, in fail-fast and in collect-all mode
+@pytest.mark.parametrize("collect_all", [False, True])
+def test_row_numbers_match_between_modes(
+        bad_date_path: Path,
+        tmp_path: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        collect_all: bool
+) -> None:
+    # Small shards, so that the bad row is far from the start of its shard
+    monkeypatch.setattr(cv, "SHARD_BYTES", 50_000)
+    out_path = tmp_path / "clean.csv"
+    runs = {
+        "full": lambda: cv.run_full(bad_date_path, out_path, collect_all=collect_all),
+        "streaming": lambda: cv.run_streaming(bad_date_path, out_path, 700, collect_all=collect_all),
+        "parallel": lambda: cv.run_parallel([bad_date_path], out_path, 2, collect_all=collect_all),
+    }
+
+    for mode, run in runs.items():
+        with pytest.raises(ValueError, match=rf"rows \[{BAD_ROW}\]"):
+            run()
+        assert not out_path.exists(), mode
+
+# The overlapped pipeline writes every item in order, and the first error of a stage stops the run
+def test_run_overlapped_keeps_order_and_raises_errors() -> None:
+    written = []
+    utilization = cv.run_overlapped(iter(range(100)), lambda item: item * 2, written.append, queue_size=2)
+
+    assert written == [item * 2 for item in range(100)]
+    assert set(utilization) >= {"read", "process", "write", "wall_seconds"}
+
+    def fail_at_ten(item: int) -> int:
+        if item == 10:
+            raise ValueError("bad item")
+        return item
+
+    with pytest.raises(ValueError, match="bad item"):
+        cv.run_overlapped(iter(range(100)), fail_at_ten, lambda item: None, queue_size=2)
+
+# Revenue in cents matches one of the three formulas within the tolerance; missing values never match
+def test_revenue_mismatch_cents() -> None:
+    sold = np.array([10, 10, 10, 10, 10])
+    price = np.array([2.5, 2.5, 2.5, 2.5, np.nan])
+    discount = np.array([0.1, 0.1, 0.1, 0.1, 0.1])
+    revenue = np.array([25.0, 22.5, 2.5, 24.0, 25.0])
+
+    mismatch = cv.revenue_mismatch_cents(sold, price, discount, revenue, 0.01)
+
+    assert mismatch.tolist() == [False, False, False, True, True]
+
+# The shipped rule spec compiles, and the compiled plan raises the same error as the built-in validator
+def test_compile_rule_plan_matches_the_built_in_rules(sample: pd.DataFrame) -> None:
+    plan = cv.compile_rule_plan(cv.load_rule_spec(RULES_PATH))
+    sample.loc[BAD_ROW, "Location"] = "Germany"
+    df = cv.convert_date(pd.read_csv(pd.io.common.StringIO(sample.to_csv(index=False))), cv.DATE_FORMAT)
+
+    with pytest.raises(ValueError) as built_in:
+        cv.validate_allowed_values(df, "Location", cv.ALLOWED_LOCATIONS)
+    with pytest.raises(ValueError) as planned:
+        cv.validate_with_plan(df, plan)
+
+    assert str(planned.value) == str(built_in.value)
+
+# The compare and formula rules of the shipped spec, run on the blocked expression engine, raise the errors of the
+# built-in validators
+@pytest.mark.parametrize("column, value", [("Units Returned", 10_000), ("Revenue", 1.23), ("Revenue", np.nan)])
+def test_compiled_cross_column_rules_match_the_built_in_rules(column: str, value: float) -> None:
+    plan = cv.compile_rule_plan(cv.load_rule_spec(RULES_PATH))
+    df = cv.convert_date(pd.read_csv(SAMPLE_PATH), cv.DATE_FORMAT)
+    df.loc[BAD_ROW, column] = value
+
+    with pytest.raises(ValueError) as built_in:
+        cv.validate_frame(df)
+    with pytest.raises(ValueError) as planned:
+        cv.validate_with_plan(df, plan)
+
+    assert str(planned.value) == str(built_in.value)
+
+# A rule spec with an unknown check is rejected
+def test_compile_rule_plan_rejects_unknown_checks() -> None:
+    spec = {"rule": [{"name": "odd", "check": "prime", "column": "Price", "message": "odd"}]}
+
+    with pytest.raises(ValueError):
+        cv.compile_rule_plan(spec)
+
+# Rules with a missing setting, a bound or tolerance that is not a number or an unknown message placeholder are
+# rejected when the spec is compiled, not when the rule runs or fails
+@pytest.mark.parametrize("rule, error", [
+    ({"check": "compare", "left": "[Units Returned]", "op": "<="}, "no right expression"),
+    ({"check": "range", "column": "Price", "min": "0"}, "min of rule 'bad' is not a number"),
+    ({"check": "formula", "column": "Revenue", "any_of": ["[Price]"], "tolerance": "0.01"}, "tolerance"),
+    ({"check": "allowed", "column": "Location"}, "needs a list of text values"),
+    ({"check": "not_missing", "column": "Price", "message": "{rows} rows missing"}, "unknown placeholders"),
+])
+def test_compile_rule_plan_rejects_invalid_rules(rule: dict, error: str) -> None:
+    spec = {"rule": [{"name": "bad", **rule}]}
+
+    with pytest.raises(ValueError, match=error):
+        cv.compile_rule_plan(spec)
+
+# A missing raw file fails the run with the usual message and exit code instead of a traceback
+def test_main_reports_a_missing_raw_file(
+        tmp_path: Path,
+        monkeypatch: pytest.MonkeyPatch,
+        capsys: pytest.CaptureFixture
+) -> None:
+    monkeypatch.setattr(cv, "RAW_PATH", tmp_path / "missing.csv")
+    monkeypatch.setattr(cv, "CLEAN_PATH", tmp_path / "clean.csv")
+
+    with pytest.raises(SystemExit) as exit_info:
+        cv.main([])
+
+    assert exit_info.value.code == 1
+    assert capsys.readouterr().err.startswith("Validation failed.")
+
+# The fused validator raises the error of the sequential validators for the first failing rule, and keeps bitmasks
+# only for the rules that fire
+@pytest.mark.parametrize("column, value", [
+    ("Units Sold", -1),
+    ("Units Returned", 10_000),
+    ("Price", 0.0),
+    ("Discount", 1.5),
+    ("Revenue", 1.23),
+])
+def test_fused_validator_matches_the_sequential_validators(column: str, value: float) -> None:
+    df = pd.read_csv(SAMPLE_PATH)
+    df[column] = df[column].astype(type(value))
+    df.loc[BAD_ROW, column] = value
+
+    with pytest.raises(ValueError) as sequential:
+        cv.validate_sold_units(df)
+        cv.validate_units_returned(df)
+        cv.validate_price(df)
+        cv.validate_discount(df)
+        cv.validate_revenue(df, cv.TOLERANCE)
+    with pytest.raises(ValueError) as fused:
+        cv.validate_numeric_fused(df, cv.TOLERANCE)
+    masks = cv.compute_fused_violations(df, cv.TOLERANCE)
+
+    assert str(fused.value) == str(sequential.value)
+    assert all(np.flatnonzero(mask).tolist() == [BAD_ROW] for mask in masks.values())
+
+# Values that pass validation only after their whitespace is trimmed are written trimmed by every output format
+def test_padded_values_are_written_trimmed(sample: pd.DataFrame, tmp_path: Path) -> None:
+    pytest.importorskip("pyarrow")
+    sample.loc[BAD_ROW, "Location"] = "UK "
+    sample.loc[BAD_ROW, "Platform"] = " Amazon"
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    out_path = tmp_path / "clean.csv"
+
+    cv.run_full(raw_path, out_path, output_formats=("csv", "parquet", "feather"))
+
+    for frame in (pd.read_csv(out_path), pd.read_parquet(out_path.with_suffix(".parquet")),
+                  pd.read_feather(out_path.with_suffix(".feather"))):
+        assert frame.loc[BAD_ROW, ["Location", "Platform"]].tolist() == ["UK", "Amazon"]
+
+# Rewriting the partitioned output with another layout replaces the old partitions, so every row is stored once
+def test_partitioned_output_replaces_an_older_layout(sample: pd.DataFrame, tmp_path: Path) -> None:
+    # A few weeks of data keep the number of partition files small
+    raw_path = tmp_path / "raw.csv"
+    sample.head(600).to_csv(raw_path, index=False)
+    out_path = tmp_path / "clean.csv"
+    root = cv.partition_root(out_path)
+    total_rows = 600
+
+    for partition_by in [(), ("Location",), ("Location", "Platform"), ()]:
+        cv.run_full(raw_path, out_path, partition_by=partition_by)
+        manifest = cv.load_manifest(root)
+        files = sorted(path.relative_to(root).as_posix() for path in root.rglob("part.csv"))
+
+        assert manifest["partition_by"] == ["year", "week", *partition_by]
+        assert sum(entry["rows"] for entry in manifest["partitions"].values()) == total_rows
+        assert files == sorted(f"{relative}/part.csv" for relative in manifest["partitions"])
+        assert sum(len(pd.read_csv(root / file)) for file in files) == total_rows
+
+# A value with padding is partitioned with its trimmed value, not into a folder of its own
+def test_partitions_use_trimmed_values(sample: pd.DataFrame, tmp_path: Path) -> None:
+    sample.loc[10, "Location"] = "UK "
+    raw_path = tmp_path / "raw.csv"
+    sample.head(600).to_csv(raw_path, index=False)
+    out_path = tmp_path / "clean.csv"
+
+    cv.run_full(raw_path, out_path, partition_by=("Location",))
+
+    folders = {path.name for path in cv.partition_root(out_path).glob("year=*/week=*/Location=*")}
+    assert folders == {"Location=Canada", "Location=UK", "Location=USA"}
+
+# Text in a numeric column is reported per row as non_numeric by collect-all runs of the typed reader, in every mode
+def test_collect_all_reports_text_in_a_numeric_column(sample: pd.DataFrame, tmp_path: Path) -> None:
+    sample.loc[BAD_ROW, "Discount"] = "abc"
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    out_path = tmp_path / "clean.csv"
+    runs = {
+        "full": lambda: cv.run_full(raw_path, out_path, collect_all=True),
+        "streaming": lambda: cv.run_streaming(raw_path, out_path, 700, collect_all=True),
+        "parallel": lambda: cv.run_parallel([raw_path], out_path, 2, collect_all=True),
+    }
+
+    for mode, run in runs.items():
+        with pytest.raises(ValueError, match=rf"non_numeric \[Discount\]: 1 rows, e.g. rows \[{BAD_ROW}\]"):
+            run()
+        assert not out_path.exists(), mode
+
+# Quarantine mode writes the rows failing a quarantine rule, with their reasons, to the rejects file and all other
+# rows to the cleaned output, in every mode
+def test_quarantine_splits_clean_and_rejected_rows(sample: pd.DataFrame, tmp_path: Path) -> None:
+    sample.loc[40, "Units Returned"] = ""
+    sample.loc[50, "Units Returned"] = "1.5"
+    sample.loc[BAD_ROW, "Location"] = "Germany"
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    out_path = tmp_path / "clean.csv"
+    runs = {
+        "full": lambda: cv.run_full(raw_path, out_path, max_reject_rate=0.01),
+        "streaming": lambda: cv.run_streaming(raw_path, out_path, 700, max_reject_rate=0.01),
+        "parallel": lambda: cv.run_parallel([raw_path], out_path, 2, max_reject_rate=0.01),
+    }
+
+    for mode, run in runs.items():
+        run()
+        clean = pd.read_csv(out_path)
+        rejects = pd.read_csv(cv.rejects_path(out_path))
+
+        assert len(clean) == len(sample) - 3, mode
+        assert clean["Units Returned"].dtype == np.int64, mode
+        assert rejects[cv.REJECT_REASON_COLUMN].tolist() == [
+            "units_returned_missing[Units Returned]",
+            "units_returned_non_integer[Units Returned]",
+            "value_not_allowed[Location]",
+        ], mode
+
+# A quarantine run that rejects more rows than the maximum reject rate allows fails and writes no output
+def test_quarantine_fails_above_the_maximum_reject_rate(sample: pd.DataFrame, tmp_path: Path) -> None:
+    sample.loc[BAD_ROW, "Price"] = "-1"
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    out_path = tmp_path / "clean.csv"
+
+    with pytest.raises(ValueError, match="Quarantine failed: 1 of"):
+        cv.run_full(raw_path, out_path, max_reject_rate=0.0)
+    assert not out_path.exists()
+    assert not cv.rejects_path(out_path).exists()
+
+# The compact schema is lossless: the cleaned csv file is the same with and without it, padded values included, in
+# every mode
+def test_compact_output_matches_the_default_output(sample: pd.DataFrame, tmp_path: Path) -> None:
+    sample.loc[BAD_ROW, "Location"] = "UK "
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    default_path = tmp_path / "default.csv"
+    out_path = tmp_path / "clean.csv"
+    cv.run_full(raw_path, default_path)
+    runs = {
+        "full": lambda: cv.run_full(raw_path, out_path, compact=True),
+        "streaming": lambda: cv.run_streaming(raw_path, out_path, 700, compact=True),
+        "parallel": lambda: cv.run_parallel([raw_path], out_path, 2, compact=True),
+    }
+
+    for mode, run in runs.items():
+        run()
+
+        assert out_path.read_bytes() == default_path.read_bytes(), mode
+
+# compact_frame downcasts to COMPACT_DTYPES and categoricals, and fails on a value the compact schema cannot hold
+def test_compact_frame_rejects_values_it_cannot_store() -> None:
+    df = cv.convert_date(pd.read_csv(SAMPLE_PATH), cv.DATE_FORMAT)
+
+    compact = cv.compact_frame(df)
+
+    assert {col: str(compact[col].dtype) for col in cv.COMPACT_DTYPES} == cv.COMPACT_DTYPES
+    assert all(isinstance(compact[col].dtype, pd.CategoricalDtype) for col in cv.ALLOWED_VALUES)
+
+    df.loc[BAD_ROW, "Units Sold"] = 70_000
+    with pytest.raises(ValueError, match="Compact schema failed: values of 'Units Sold'"):
+        cv.compact_frame(df)
+
+# A run through the parsed cache writes the same cleaned file as a run that parses the csv file, and the next read
+# memory-maps the cache without parsing
+def test_parsed_cache_matches_the_csv_reader(
+        sample: pd.DataFrame,
+        tmp_path: Path,
+        monkeypatch: pytest.MonkeyPatch
+) -> None:
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    default_path = tmp_path / "default.csv"
+    out_path = tmp_path / "clean.csv"
+
+    cv.run_full(raw_path, default_path)
+    cv.run_full(raw_path, out_path, parsed_cache=True)
+
+    assert out_path.read_bytes() == default_path.read_bytes()
+    assert (cv.parsed_cache_dir(raw_path) / "manifest.json").exists()
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError("the csv file was parsed")
+
+    monkeypatch.setattr(cv, "read_raw", no_parsing)
+    cached = cv.read_raw_cached(raw_path)
+
+    assert isinstance(cached["Price"].to_numpy().base, np.memmap)
+
+# A change of the raw file's content makes the parsed cache stale; touching the file alone does not
+def test_parsed_cache_is_invalidated_by_a_content_change(sample: pd.DataFrame, tmp_path: Path) -> None:
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    cv.read_raw_cached(raw_path)
+
+    raw_path.touch()
+    assert cv.load_parsed_cache(raw_path) is not None
+
+    sample.loc[BAD_ROW, "Price"] = "1.23"
+    sample.to_csv(raw_path, index=False)
+    assert cv.load_parsed_cache(raw_path) is None
+    assert cv.read_raw_cached(raw_path).loc[BAD_ROW, "Price"] == 1.23
+
+# A multi-file collect-all run reports a column missing from one file, and names the file of every sampled row with
+# the row number within that file
+def test_multi_file_collect_all_names_the_file_of_each_row(sample: pd.DataFrame, tmp_path: Path) -> None:
+    good_path = tmp_path / "a.csv"
+    short_path = tmp_path / "b.csv"
+    sample.loc[BAD_ROW, "Location"] = "Germany"
+    sample.to_csv(good_path, index=False)
+    sample.head(600).drop(columns=["Platform"]).to_csv(short_path, index=False)
+    report_path = tmp_path / "report.json"
+
+    with pytest.raises(ValueError, match="schema_missing_column"):
+        cv.run_parallel(
+            [good_path, short_path], tmp_path / "clean.csv", 2,
+            collect_all=True, report_path=str(report_path), source_column=True
+        )
+    violations = {v["rule"]: v for v in json.loads(report_path.read_text())["violations"]}
+
+    assert violations["schema_missing_column"]["violations"] == 600
+    assert violations["value_not_allowed"]["sample_rows"] == [BAD_ROW]
+    assert violations["value_not_allowed"]["sample_files"] == [str(good_path)]
+
+# A single input file gets the Source File column in streaming mode as in parallel mode
+def test_streaming_input_adds_the_source_column(sample: pd.DataFrame, tmp_path: Path) -> None:
+    raw_path = tmp_path / "raw.csv"
+    sample.to_csv(raw_path, index=False)
+    parallel_path = tmp_path / "parallel.csv"
+    out_path = tmp_path / "clean.csv"
+
+    cv.run_parallel([raw_path], parallel_path, 1, source_column=True)
+    cv.run_streaming(raw_path, out_path, 700, source_column=True)
+
+    assert out_path.read_bytes() == parallel_path.read_bytes()
+    assert pd.read_csv(out_path)[cv.SOURCE_COLUMN].unique().tolist() == [str(raw_path)]
+
+# Compressed raw files are read, and the cleaned csv file is written, to the same bytes as the uncompressed ones, in
+# every mode
+@pytest.mark.parametrize("codec, module", [("gzip", gzip), ("bz2", bz2)])
+def test_compressed_input_and_output_match_the_uncompressed_files(
+        codec: str,
+        module: ModuleType,
+        tmp_path: Path
+) -> None:
+    raw_path = cv.compressed_path(tmp_path / "raw.csv", codec)
+    raw_path.write_bytes(module.compress(SAMPLE_PATH.read_bytes()))
+    default_path = tmp_path / "default.csv"
+    out_path = tmp_path / "clean.csv"
+    cv.run_full(SAMPLE_PATH, default_path)
+    runs = {
+        "full": lambda: cv.run_full(raw_path, out_path, compression=codec),
+        "streaming": lambda: cv.run_streaming(raw_path, out_path, 700, compression=codec),
+        "parallel": lambda: cv.run_parallel([raw_path], out_path, 2, compression=codec),
+    }
+
+    for mode, run in runs.items():
+        run()
+
+        assert module.decompress(cv.compressed_path(out_path, codec).read_bytes()) == default_path.read_bytes(), mode
+
+# A truncated compressed raw file fails the run with the decompression error and writes no output
+def test_truncated_compressed_input_fails(tmp_path: Path) -> None:
+    raw_path = tmp_path / "raw.csv.gz"
+    data = gzip.compress(SAMPLE_PATH.read_bytes())
+    raw_path.write_bytes(data[:len(data) // 2])
+    out_path = tmp_path / "clean.csv"
+
+    with pytest.raises(ValueError, match="cannot decompress"):
+        cv.run_full(raw_path, out_path)
+    assert not out_path.exists()
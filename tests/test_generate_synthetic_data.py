@@ -0,0 +1,33 @@
+# Tests of generate_synthetic_data.py
+
+# Imports
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+import clean_and_validate as cv
+import generate_synthetic_data as gen
+
+# Tests
+
+# Every injected error kind breaks its own validation rule only (negative_units_sold also breaks the Units Returned
+# <= Units Sold rule)
+@pytest.mark.parametrize("kind, rules", [
+    ("bad_date", {"date_invalid_or_missing"}),
+    ("missing_value", {"missing_or_blank"}),
+    ("unknown_product", {"value_not_allowed"}),
+    ("negative_units_sold", {"units_sold_negative", "units_returned_exceed_sold"}),
+    ("returned_exceed_sold", {"units_returned_exceed_sold"}),
+    ("non_positive_price", {"price_non_positive"}),
+    ("discount_out_of_range", {"discount_out_of_range"}),
+    ("revenue_mismatch", {"revenue_no_formula_match"}),
+])
+def test_error_kinds_break_their_own_rule(kind: str, rules: set, tmp_path: Path) -> None:
+    out_path = tmp_path / "raw.csv"
+    gen.generate(out_path, 5000, error_rates={kind: 0.02})
+
+    _, violations = cv.collect_violations(pd.read_csv(out_path), cv.TOLERANCE)
+
+    assert {violation["rule"] for violation in violations} == rules
+    assert len({violation["violations"] for violation in violations}) == 1
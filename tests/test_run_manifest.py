@@ -0,0 +1,42 @@
+# Tests of the skip-if-unchanged fast path of run_manifest.py
+
+# Imports
+from pathlib import Path
+
+from run_manifest import file_state, run_unchanged, write_run_manifest
+
+# Tests
+
+# A run is skipped only while the raw file, the outputs and the --rules file are unchanged
+def test_run_unchanged_checks_the_rules_file(tmp_path: Path) -> None:
+    raw_path, out_path, rules_path, script_path = (
+        tmp_path / name for name in ("raw.csv", "clean.csv", "rules.toml", "script.py")
+    )
+    for path in (raw_path, out_path, rules_path, script_path):
+        path.write_text(path.name)
+    manifest_path = tmp_path / ".run_manifest.json"
+    argv = ["--rules", str(rules_path), "--skip-unchanged"]
+    write_run_manifest(
+        file_state(raw_path), [out_path], "ruleset", script_path, argv, file_state(rules_path), manifest_path=manifest_path
+    )
+
+    assert run_unchanged(script_path, argv, manifest_path)
+
+    rules_path.write_text("[[rule]]\n")
+
+    assert not run_unchanged(script_path, argv, manifest_path)
+
+# Rows appended to the raw file while a run reads it are not recorded as processed
+def test_run_manifest_keeps_the_raw_state_from_before_the_run(tmp_path: Path) -> None:
+    raw_path, out_path, script_path = (tmp_path / name for name in ("raw.csv", "clean.csv", "script.py"))
+    for path in (raw_path, out_path, script_path):
+        path.write_text(path.name)
+    manifest_path = tmp_path / ".run_manifest.json"
+    argv = ["--skip-unchanged"]
+    raw_state = file_state(raw_path)
+
+    with open(raw_path, "a") as f:
+        f.write("appended row\n")
+    write_run_manifest(raw_state, [out_path], "ruleset", script_path, argv, manifest_path=manifest_path)
+
+    assert not run_unchanged(script_path, argv, manifest_path)